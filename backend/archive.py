@@ -0,0 +1,196 @@
+"""
+Archivo histórico (hot/cold) para mensajes, publicaciones y pedidos antiguos.
+
+Documents older than a collection's retention window are moved out of the
+hot collection, either into ``<collection>_archive`` or into gzip-compressed
+NDJSON files partitioned by day::
+
+    <ARCHIVE_DIR>/<collection>/<YYYY>/<MM>/<YYYY-MM-DD>.ndjson.gz
+
+Documents are written to the archive before they are deleted, so an
+interrupted run can only duplicate, never lose; readers dedupe by ``id``.
+Each run also bumps ``archived_<collection>`` in the ``counters`` collection so
+totals can still include cold data without counting it, and raises its
+``archived_before`` to the run's cutoff: readers only look in the archive for
+documents older than that.
+"""
+import asyncio
+import gzip
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from bson import json_util
+from bson.json_util import JSONOptions, JSONMode
+from pymongo import ReplaceOne
+
+ARCHIVE_DIR = Path(os.environ.get("ARCHIVE_DIR", Path(__file__).parent / "archive"))
+ARCHIVE_MODE = os.environ.get("ARCHIVE_MODE", "file")  # "file" o "collection"
+COUNTERS_COLLECTION = "counters"
+BATCH_SIZE = 5000
+
+# Días que un documento permanece en la colección principal
+RETENTION_DAYS = {
+    "whatsapp_messages": 90,
+    "social_media_posts": 180,
+    "orders": 365,
+}
+
+# Only documents that will not change again are archived
+ARCHIVE_FILTERS = {
+    "orders": {"status": {"$in": ["entregado", "cancelado"]}},
+}
+
+_JSON_OPTIONS = JSONOptions(json_mode=JSONMode.RELAXED, tz_aware=True)
+
+
+def archive_cutoff(collection, now=None):
+    now = now or datetime.now(timezone.utc)
+    return now - timedelta(days=RETENTION_DAYS[collection])
+
+
+def _partition_path(collection, day):
+    return ARCHIVE_DIR / collection / f"{day:%Y}" / f"{day:%m}" / f"{day:%Y-%m-%d}.ndjson.gz"
+
+
+def _write_partitions(collection, docs):
+    partitions = {}
+    for doc in docs:
+        partitions.setdefault(doc["created_at"].date(), []).append(doc)
+    for day, day_docs in partitions.items():
+        path = _partition_path(collection, day)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Appending a new gzip member keeps earlier runs intact and readable
+        with gzip.open(path, "at", encoding="utf-8") as fh:
+            for doc in day_docs:
+                fh.write(json_util.dumps(doc, json_options=_JSON_OPTIONS) + "\n")
+
+
+def _read_partitions(collection, since, until):
+    docs = {}
+    day = since.date()
+    while day <= until.date():
+        path = _partition_path(collection, day)
+        if path.exists():
+            with gzip.open(path, "rt", encoding="utf-8") as fh:
+                for line in fh:
+                    doc = json_util.loads(line, json_options=_JSON_OPTIONS)
+                    if since <= doc["created_at"] < until:
+                        docs[doc.get("id", doc["_id"])] = doc
+        day += timedelta(days=1)
+    return list(docs.values())
+
+
+async def archive_collection(db, collection, older_than_days=None, mode=None):
+    """Move documents past retention out of ``collection``; returns the count."""
+    mode = mode or ARCHIVE_MODE
+    days = older_than_days if older_than_days is not None else RETENTION_DAYS[collection]
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    query = {"created_at": {"$lt": cutoff}, **ARCHIVE_FILTERS.get(collection, {})}
+    loop = asyncio.get_running_loop()
+
+    moved = 0
+    while True:
+        docs = await db[collection].find(query).sort("created_at", 1).limit(BATCH_SIZE).to_list(BATCH_SIZE)
+        if not docs:
+            break
+        for doc in docs:
+            doc["created_at"] = doc["created_at"].replace(tzinfo=timezone.utc)
+        if mode == "collection":
+            # Replace rather than insert so a rerun after a crash does not fail on _id
+            await db[f"{collection}_archive"].bulk_write(
+                [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs], ordered=False
+            )
+        else:
+            await loop.run_in_executor(None, _write_partitions, collection, docs)
+        result = await db[collection].delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        await db[COUNTERS_COLLECTION].update_one(
+            {"_id": f"archived_{collection}"},
+            {"$inc": {"count": result.deleted_count}, "$max": {"archived_before": cutoff}},
+            upsert=True
+        )
+        moved += result.deleted_count
+    return moved
+
+
+async def archived_count(db, collection):
+    counter = await db[COUNTERS_COLLECTION].find_one({"_id": f"archived_{collection}"})
+    return counter["count"] if counter else 0
+
+
+async def archived_before(db, collection):
+    """
+    Cutoff of the most recent run that archived ``collection``, or ``None``
+    if nothing was archived. Nothing newer than this is in the archive.
+    """
+    counter = await db[COUNTERS_COLLECTION].find_one({"_id": f"archived_{collection}"})
+    if not counter:
+        return None
+    if "archived_before" not in counter:
+        # Archived before the cutoff was recorded; the next run records it
+        return datetime.now(timezone.utc)
+    return counter["archived_before"].replace(tzinfo=timezone.utc)
+
+
+def _scan_partitions(collection, match, limit):
+    docs = {}
+    # Partition paths sort by date, so this reads the newest days first
+    for path in sorted((ARCHIVE_DIR / collection).glob("*/*/*.ndjson.gz"), reverse=True):
+        with gzip.open(path, "rt", encoding="utf-8") as fh:
+            for line in fh:
+                doc = json_util.loads(line, json_options=_JSON_OPTIONS)
+                if all(doc.get(field) == value for field, value in match.items()):
+                    docs[doc.get("id", doc["_id"])] = doc
+        if limit and len(docs) >= limit:
+            break
+    return list(docs.values())
+
+
+async def find_archived(db, collection, match, limit=None, mode=None):
+    """
+    Archived documents matching the equality filters in ``match`` at any
+    date, newest first. In file mode this reads partitions until ``limit``
+    documents are found, so it is meant for lookups by id or owner.
+    """
+    mode = mode or ARCHIVE_MODE
+    if mode == "collection":
+        docs = await db[f"{collection}_archive"].find(match).sort("created_at", -1).to_list(limit)
+    else:
+        docs = await asyncio.get_running_loop().run_in_executor(None, _scan_partitions, collection, match, limit)
+    for doc in docs:
+        doc["created_at"] = doc["created_at"].replace(tzinfo=timezone.utc)
+    docs.sort(key=lambda doc: doc["created_at"], reverse=True)
+    return docs[:limit] if limit else docs
+
+
+async def query_archive(db, collection, since, until, match=None, mode=None):
+    """Archived documents with ``since <= created_at < until`` matching ``match``."""
+    mode = mode or ARCHIVE_MODE
+    match = match or {}
+    if mode == "collection":
+        query = {"created_at": {"$gte": since, "$lt": until}, **match}
+        return await db[f"{collection}_archive"].find(query).to_list(None)
+    docs = await asyncio.get_running_loop().run_in_executor(None, _read_partitions, collection, since, until)
+    return [doc for doc in docs if all(doc.get(field) == value for field, value in match.items())]
+
+
+async def find_with_archive(db, collection, query, since, limit, match=None, projection=None):
+    """
+    Newest-first listing that falls through to the archive when ``since``
+    reaches past what has been archived. ``match`` holds the equality filters
+    also applied to archived documents; ``projection`` only applies to the
+    hot collection.
+    """
+    since = since.replace(tzinfo=timezone.utc) if since.tzinfo is None else since
+    docs = await db[collection].find(
+        {**query, "created_at": {"$gte": since}}, projection
+    ).sort("created_at", -1).limit(limit).to_list(limit)
+    # Manual runs may archive inside the retention window, so the bound is the recorded cutoff
+    boundary = await archived_before(db, collection) if len(docs) < limit else None
+    if boundary and since < boundary:
+        seen = {doc["id"] for doc in docs}
+        archived = await query_archive(db, collection, since, boundary, match)
+        archived = [doc for doc in archived if doc["id"] not in seen]
+        archived.sort(key=lambda doc: doc["created_at"], reverse=True)
+        docs.extend(archived[:limit - len(docs)])
+    return docs
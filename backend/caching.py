@@ -0,0 +1,132 @@
+"""
+Caché de lecturas con single-flight para endpoints de solo lectura.
+
+``SingleFlightCache`` keeps results in memory for a few seconds and makes
+concurrent requests for the same key share one computation, so the number
+of queries an endpoint sends to Mongo no longer grows with its number of
+viewers. With ``stale_while_revalidate`` a hit in the last part of the TTL
+starts one background refresh and keeps serving the current value, so
+viewers never wait on a recomputation after the first one.
+
+The cache is per process; every uvicorn worker computes its own copy.
+"""
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+
+_caches = []
+
+
+class SingleFlightCache:
+    def __init__(self, name, ttl_seconds=3.0, stale_while_revalidate=False, refresh_ahead_seconds=None,
+                 max_entries=256):
+        self.name = name
+        self.ttl = ttl_seconds
+        self.stale_while_revalidate = stale_while_revalidate
+        # Por defecto se refresca durante el último tercio del TTL
+        self.refresh_ahead = refresh_ahead_seconds if refresh_ahead_seconds is not None else ttl_seconds / 3
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._inflight = {}  # key -> task computing it
+        self._generation = 0  # Bumped by invalidate()
+        self._stale_marks = 0  # Bumped by mark_stale()
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.computations = 0
+        self.background_refreshes = 0
+        _caches.append(self)
+
+    async def get(self, key, compute):
+        """Return the cached value for ``key`` or the result of ``await compute()``."""
+        self.requests += 1
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry and now < entry[1]:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            if self.stale_while_revalidate and now >= entry[1] - self.refresh_ahead and key not in self._inflight:
+                self.background_refreshes += 1
+                self._start(key, compute)
+            return entry[0]
+        if key in self._inflight:
+            self.coalesced += 1
+            task = self._inflight[key]
+        else:
+            task = self._start(key, compute)
+        # A caller that disconnects does not cancel the computation the others wait on
+        return await asyncio.shield(task)
+
+    def _start(self, key, compute):
+        self.computations += 1
+        task = asyncio.create_task(compute())
+        self._inflight[key] = task
+        # Registered before any waiter, so the value is stored when they resume
+        task.add_done_callback(functools.partial(self._store, key, self._generation, self._stale_marks))
+        return task
+
+    def _store(self, key, generation, stale_marks, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Failures are not cached; retrieving the exception keeps a refresh nobody awaits quiet
+        if task.cancelled() or task.exception() is not None:
+            return
+        if generation != self._generation:
+            # Started before an invalidation, so it may predate the write
+            return
+        now = time.monotonic()
+        # A write during the computation: keep the newer value but refresh it on the next read
+        lifetime = self.ttl if stale_marks == self._stale_marks else min(self.ttl, self.refresh_ahead)
+        self._entries[key] = (task.result(), now + lifetime)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Drop cached values; computations already running are not stored or shared."""
+        self._generation += 1
+        if key is None:
+            self._entries.clear()
+            self._inflight.clear()
+        else:
+            self._entries.pop(key, None)
+            self._inflight.pop(key, None)
+
+    def mark_stale(self):
+        """
+        After a write: keep serving current values, but make the next read
+        start a refresh. Computations already running are still stored, as
+        stale too, so a steady stream of writes cannot starve the cache.
+        Without stale-while-revalidate this is ``invalidate()``.
+        """
+        if not self.stale_while_revalidate:
+            return self.invalidate()
+        self._stale_marks += 1
+        deadline = time.monotonic() + self.refresh_ahead
+        for key, (value, expires_at) in self._entries.items():
+            self._entries[key] = (value, min(expires_at, deadline))
+
+    def cached(self, func):
+        """Decorate an ``async`` endpoint; its keyword arguments form the key."""
+        @functools.wraps(func)
+        async def wrapper(**kwargs):
+            key = tuple(sorted(kwargs.items()))
+            return await self.get(key, lambda: func(**kwargs))
+        return wrapper
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "requests": self.requests,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "computations": self.computations,
+            "background_refreshes": self.background_refreshes,
+            "hit_ratio": round(self.hits / self.requests, 3) if self.requests else None,
+            "coalescing_ratio": round(self.coalesced / self.requests, 3) if self.requests else None,
+        }
+
+
+def cache_stats():
+    return {cache.name: cache.stats() for cache in _caches}
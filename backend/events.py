@@ -0,0 +1,130 @@
+"""
+Bus de eventos en proceso para notificaciones en tiempo real (SSE).
+
+Write paths in server.py publish small deltas here and every connected
+``/api/events/stream`` client gets its own bounded queue. Publishing never
+blocks: a client whose queue fills up is evicted and has to reconnect, using
+``Last-Event-ID`` to replay what it missed from the recent-events ring.
+
+The bus lives in the worker process, so each uvicorn worker only sees the
+writes it handled itself.
+"""
+import asyncio
+import itertools
+import json
+from collections import deque
+from datetime import datetime, timezone
+
+CLIENT_BUFFER_SIZE = 256   # Eventos pendientes por cliente antes de expulsarlo
+MAX_SUBSCRIBERS = 2000     # Conexiones simultáneas por worker
+REPLAY_BUFFER_SIZE = 1000  # Eventos recientes para reconexión con Last-Event-ID
+HEARTBEAT_SECONDS = 15
+
+TOPICS = ("dashboard", "orders", "stock", "whatsapp")
+
+_EVICTED = object()
+
+
+class Subscription:
+    def __init__(self, topics, buffer_size):
+        self.topics = set(topics) if topics else set(TOPICS)
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.evicted = False
+
+
+class EventBus:
+    def __init__(self, buffer_size=CLIENT_BUFFER_SIZE, max_subscribers=MAX_SUBSCRIBERS,
+                 replay_size=REPLAY_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.recent = deque(maxlen=replay_size)
+        self._ids = itertools.count(1)
+        self.published = 0
+        self.delivered = 0
+        self.evictions = 0
+
+    def subscribe(self, topics=None):
+        if len(self.subscribers) >= self.max_subscribers:
+            return None
+        subscription = Subscription(topics, self.buffer_size)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    def replay(self, last_event_id, topics=None):
+        """Events newer than ``last_event_id`` still held in the ring buffer."""
+        topics = set(topics) if topics else set(TOPICS)
+        return [event for event in self.recent if event["id"] > last_event_id and event["topic"] in topics]
+
+    def publish(self, topic, event_type, data):
+        """Fan an event out to every matching subscriber without awaiting."""
+        event = {
+            "id": next(self._ids),
+            "topic": topic,
+            "type": event_type,
+            "data": data,
+            "at": datetime.now(timezone.utc),
+        }
+        self.recent.append(event)
+        self.published += 1
+        for subscription in list(self.subscribers):
+            if subscription.evicted or topic not in subscription.topics:
+                continue
+            try:
+                subscription.queue.put_nowait(event)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                self._evict(subscription)
+        return event
+
+    def _evict(self, subscription):
+        # Drop the backlog so the sentinel fits; the client resumes via Last-Event-ID
+        subscription.evicted = True
+        self.evictions += 1
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(_EVICTED)
+        self.subscribers.discard(subscription)
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "delivered": self.delivered,
+            "evictions": self.evictions,
+            "last_event_id": self.recent[-1]["id"] if self.recent else 0,
+        }
+
+
+def format_sse(event):
+    payload = json.dumps({"type": event["type"], "data": event["data"], "at": event["at"]}, default=str)
+    return f"id: {event['id']}\nevent: {event['topic']}\ndata: {payload}\n\n"
+
+
+async def stream_events(bus, subscription, last_event_id=None):
+    """Async generator producing the SSE body for one subscription."""
+    replayed_up_to = 0
+    try:
+        if last_event_id is not None:
+            for event in bus.replay(last_event_id, subscription.topics):
+                replayed_up_to = event["id"]
+                yield format_sse(event)
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if event is _EVICTED:
+                yield "event: evicted\ndata: {}\n\n"
+                break
+            if event["id"] > replayed_up_to:
+                yield format_sse(event)
+    finally:
+        bus.unsubscribe(subscription)
+
+
+event_bus = EventBus()
@@ -0,0 +1,180 @@
+"""
+Pronóstico de demanda y cálculo de puntos de reorden para Tambar Express.
+
+Builds a daily demand series per product from ``orders.items`` and runs simple
+exponential smoothing over all products at once (one numpy vector per day).
+The smoothed level and error variance are stored alongside each suggestion so
+a daily refresh only has to replay the days since the last run.
+"""
+import asyncio
+import math
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from pymongo import UpdateOne
+
+SUGGESTIONS_COLLECTION = "reorder_suggestions"
+
+SMOOTHING_ALPHA = 0.2       # Peso de la observación más reciente
+SERVICE_LEVEL_Z = 1.65      # ~95% nivel de servicio
+DEFAULT_LEAD_TIME_DAYS = 3  # Días de entrega del proveedor si no se especifica
+REVIEW_PERIOD_DAYS = 7      # Cobertura de cada pedido al proveedor
+
+
+def _day_key(day):
+    return day.strftime("%Y-%m-%d")
+
+
+async def fetch_daily_demand(db, since=None, until=None):
+    """Aggregate units sold per (product_id, day), excluding cancelled orders."""
+    match = {"status": {"$ne": "cancelado"}}
+    created = {}
+    if since is not None:
+        created["$gte"] = datetime.combine(since, datetime.min.time()).replace(tzinfo=timezone.utc)
+    if until is not None:
+        created["$lt"] = datetime.combine(until, datetime.min.time()).replace(tzinfo=timezone.utc)
+    if created:
+        match["created_at"] = created
+
+    pipeline = [
+        {"$match": match},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {
+                "product_id": "$items.product_id",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+            },
+            "quantity": {"$sum": "$items.quantity"},
+        }},
+    ]
+    rows = await db.orders.aggregate(pipeline, allowDiskUse=True).to_list(None)
+    return [(r["_id"]["product_id"], r["_id"]["day"], r["quantity"]) for r in rows]
+
+
+def build_demand_matrix(rows, product_ids, start, days):
+    """Scatter (product_id, day, quantity) rows into a products x days matrix."""
+    demand = np.zeros((len(product_ids), days), dtype=np.float64)
+    if not rows or days <= 0:
+        return demand
+
+    product_index = {pid: i for i, pid in enumerate(product_ids)}
+    day_index = {_day_key(start + timedelta(days=d)): d for d in range(days)}
+    p_idx, d_idx, qty = [], [], []
+    for product_id, day, quantity in rows:
+        if product_id in product_index and day in day_index:
+            p_idx.append(product_index[product_id])
+            d_idx.append(day_index[day])
+            qty.append(quantity)
+    np.add.at(demand, (np.array(p_idx, dtype=np.intp), np.array(d_idx, dtype=np.intp)), qty)
+    return demand
+
+
+def smooth(demand, level, variance, first_day, alpha=SMOOTHING_ALPHA):
+    """
+    Exponential smoothing across every product in one pass over the days.
+
+    ``first_day`` holds, per product, the first column that has not been
+    folded into its state yet; earlier columns are skipped for that row.
+    """
+    level = level.copy()
+    variance = variance.copy()
+    for d in range(demand.shape[1]):
+        observed = demand[:, d]
+        error = observed - level
+        active = d >= first_day
+        level = np.where(active, level + alpha * error, level)
+        variance = np.where(active, (1 - alpha) * (variance + alpha * error ** 2), variance)
+    return level, variance
+
+
+def reorder_points(level, variance, lead_time, stock):
+    """Return (min_stock, reorder_qty) arrays from the smoothed demand."""
+    sigma = np.sqrt(variance)
+    safety_stock = SERVICE_LEVEL_Z * sigma * np.sqrt(lead_time)
+    reorder_point = np.ceil(level * lead_time + safety_stock)
+    order_up_to = reorder_point + np.ceil(level * REVIEW_PERIOD_DAYS)
+    reorder_qty = np.maximum(order_up_to - stock, 0)
+    return reorder_point.astype(int), reorder_qty.astype(int)
+
+
+async def refresh_reorder_suggestions(db, full=False, today=None):
+    """
+    Update ``reorder_suggestions`` from order history.
+
+    Only complete days (up to yesterday) are folded in. With ``full=True`` the
+    stored smoothing state is discarded and the whole history is replayed.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    products = await db.products.find(
+        {}, {"_id": 0, "id": 1, "name": 1, "stock": 1, "min_stock": 1, "lead_time_days": 1}
+    ).to_list(None)
+    if not products:
+        return {"products": 0, "days": 0}
+
+    product_ids = [p["id"] for p in products]
+    state = {}
+    if not full:
+        async for doc in db[SUGGESTIONS_COLLECTION].find(
+            {"product_id": {"$in": product_ids}},
+            {"_id": 0, "product_id": 1, "level": 1, "variance": 1, "last_day": 1},
+        ):
+            state[doc["product_id"]] = doc
+
+    # Replay from the oldest day any product still needs
+    pending = [
+        datetime.strptime(state[pid]["last_day"], "%Y-%m-%d").date() + timedelta(days=1)
+        for pid in product_ids if pid in state
+    ]
+    if full or len(pending) < len(product_ids):
+        first = await db.orders.find_one({}, {"created_at": 1}, sort=[("created_at", 1)])
+        start = first["created_at"].date() if first else today
+        if pending:
+            start = min([start] + pending)
+    else:
+        start = min(pending)
+    days = max((today - start).days, 0)
+
+    rows = await fetch_daily_demand(db, since=start, until=today) if days else []
+    demand = build_demand_matrix(rows, product_ids, start, days)
+
+    level = np.array([state.get(pid, {}).get("level", 0.0) for pid in product_ids])
+    variance = np.array([state.get(pid, {}).get("variance", 0.0) for pid in product_ids])
+    first_day = np.array([
+        (datetime.strptime(state[pid]["last_day"], "%Y-%m-%d").date() + timedelta(days=1) - start).days
+        if pid in state else 0
+        for pid in product_ids
+    ])
+    # numpy releases the GIL, keep the smoothing pass off the event loop
+    level, variance = await asyncio.get_running_loop().run_in_executor(
+        None, smooth, demand, level, variance, first_day
+    )
+
+    lead_time = np.array([p.get("lead_time_days") or DEFAULT_LEAD_TIME_DAYS for p in products], dtype=np.float64)
+    stock = np.array([p.get("stock", 0) for p in products], dtype=np.float64)
+    min_stock, reorder_qty = reorder_points(level, variance, lead_time, stock)
+
+    last_day = _day_key(today - timedelta(days=1))
+    now = datetime.now(timezone.utc)
+    ops = []
+    for i, product in enumerate(products):
+        ops.append(UpdateOne(
+            {"product_id": product["id"]},
+            {"$set": {
+                "product_id": product["id"],
+                "product_name": product["name"],
+                "stock": product.get("stock", 0),
+                "current_min_stock": product.get("min_stock", 10),
+                "lead_time_days": int(lead_time[i]),
+                "forecast_daily_demand": round(float(level[i]), 3),
+                "demand_std": round(math.sqrt(float(variance[i])), 3),
+                "suggested_min_stock": int(min_stock[i]),
+                "suggested_reorder_qty": int(reorder_qty[i]),
+                "level": float(level[i]),
+                "variance": float(variance[i]),
+                "last_day": last_day,
+                "updated_at": now,
+            }},
+            upsert=True,
+        ))
+    await db[SUGGESTIONS_COLLECTION].bulk_write(ops, ordered=False)
+    return {"products": len(products), "days": days, "since": _day_key(start)}
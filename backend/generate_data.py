@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Generador de datos sintéticos a escala para Tambar Express.
+
+Unlike seed_data.py's handful of fixed samples, this produces any number of
+products, customers and orders with realistic shapes: Zipfian product and
+customer popularity, evening and weekend peaks, a category mix and a share
+of cancelled orders. Output is fully determined by ``--seed``: every order
+chunk draws from its own child of one SeedSequence, so the result does not
+depend on how many workers generated it. With ``--append`` the seed is mixed
+with the current collection sizes, so appending twice with the same
+``--seed`` adds new products and customers instead of repeating their ids.
+
+    python generate_data.py --products 2000 --customers 200000 --orders 3000000
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+from archive import ARCHIVE_DIR, COUNTERS_COLLECTION  # noqa: E402
+from forecasting import SUGGESTIONS_COLLECTION  # noqa: E402
+from helpers import calculate_margin, calculate_taxes, customer_search_fields  # noqa: E402
+from holds import HOLDS_COLLECTION  # noqa: E402
+from inventory import DEFAULT_BRANCH_ID, INVENTORY_COLLECTION, inventory_doc  # noqa: E402
+from outbox import EVENTS_COLLECTION  # noqa: E402
+from rendering import payment_payload  # noqa: E402
+
+CHUNK_SIZE = 20000
+
+# Mezcla de categorías: (peso, precio de costo típico en Bs.)
+CATEGORIES = {
+    "cervezas": (0.35, 6.0),
+    "vinos": (0.15, 45.0),
+    "licores": (0.15, 55.0),
+    "whiskey": (0.08, 120.0),
+    "vodka": (0.10, 70.0),
+    "ron": (0.10, 65.0),
+    "otros": (0.07, 15.0),
+}
+BRANDS = {
+    "cervezas": ["Paceña", "Huari", "Potosina", "Pilsener", "Corona", "Heineken", "Bock"],
+    "vinos": ["Kohlberg", "Campos de Solana", "Aranjuez", "La Concepción", "Casa Real", "Kuhlmann"],
+    "licores": ["Singani Casa Real", "Singani Los Parras", "Pisco Control C", "Fernet Branca", "Amaretto"],
+    "whiskey": ["Johnnie Walker", "Chivas Regal", "Jack Daniel's", "Ballantine's", "Jameson"],
+    "vodka": ["Smirnoff", "Absolut", "Skyy", "Grey Goose", "Stolichnaya"],
+    "ron": ["Bacardi", "Havana Club", "Flor de Caña", "Captain Morgan", "Abuelo"],
+    "otros": ["Coca-Cola", "Hielo", "Agua Vital", "Red Bull", "Maní salado"],
+}
+SIZES = ["330ml", "355ml", "473ml", "750ml", "1L", "Pack x6", "Pack x12"]
+SUPPLIERS = ["Cervecería Boliviana Nacional", "Bodegas Kohlberg", "Importadora Premium",
+             "Distribuidora Caribe", "Importadora México", "Importadora Perú", "Distribuidora Andina"]
+FIRST_NAMES = ["Carlos", "María", "Roberto", "Ana", "Luis", "Sofía", "Jorge", "Valeria", "Diego", "Camila",
+               "Juan", "Lucía", "Fernando", "Daniela", "Marco", "Gabriela", "Andrés", "Paola", "Miguel", "Natalia"]
+LAST_NAMES = ["Mendoza", "García", "Silva", "Quispe", "Mamani", "Rojas", "Flores", "Vargas", "Gutiérrez",
+              "Choque", "Torrez", "Álvarez", "Condori", "Salazar", "Ríos", "Paz", "Arce", "Morales"]
+ZONES = ["Zona Sur", "Sopocachi", "Miraflores", "San Miguel", "Calacoto", "Achumani", "Obrajes", "Centro"]
+
+WEEKDAY_WEIGHTS = np.array([0.8, 0.8, 0.9, 1.0, 1.4, 1.8, 1.2])  # Lunes..Domingo
+HOUR_WEIGHTS = np.array([0.6, 0.4, 0.2, 0.1, 0.1, 0.1, 0.1, 0.2, 0.3, 0.4, 0.5, 0.7,
+                         0.9, 0.8, 0.7, 0.8, 1.0, 1.4, 2.0, 2.6, 3.0, 2.8, 2.0, 1.2])
+UTC_OFFSET_HOURS = 4  # Bolivia es UTC-4
+CANCEL_RATE = 0.05
+PAYMENT_METHODS = ["efectivo", "qr", "tigo_money", "banco", "tarjeta"]
+PAYMENT_WEIGHTS = [0.35, 0.30, 0.15, 0.10, 0.10]
+OPEN_STATUSES = ["pendiente", "confirmado", "en_preparacion", "en_entrega"]
+
+
+def zipf_weights(n, exponent):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def uuids(rng, n):
+    raw = rng.integers(0, 256, size=(n, 16), dtype=np.uint8).tobytes()
+    return [str(uuid.UUID(bytes=raw[i * 16:(i + 1) * 16], version=4)) for i in range(n)]
+
+
+def generate_products(rng, n, created_at):
+    names = list(CATEGORIES)
+    weights = np.array([CATEGORIES[c][0] for c in names])
+    categories = rng.choice(len(names), size=n, p=weights / weights.sum())
+    base_cost = np.array([CATEGORIES[c][1] for c in names])[categories]
+    cost = np.round(base_cost * rng.lognormal(0, 0.35, n), 2)
+    sale = np.round(cost * rng.uniform(1.3, 1.8, n), 1)
+    ids = uuids(rng, n)
+    products = []
+    for i in range(n):
+        category = names[categories[i]]
+        brands = BRANDS[category]
+        name = f"{brands[rng.integers(len(brands))]} {SIZES[rng.integers(len(SIZES))]} #{i + 1}"
+        products.append({
+            "id": ids[i],
+            "name": name,
+            "description": f"{category.capitalize()} - {name}",
+            "cost_price": float(cost[i]),
+            "sale_price": float(sale[i]),
+            "margin": round(calculate_margin(float(cost[i]), float(sale[i])), 2),
+            "stock": int(rng.integers(0, 300)),
+            "min_stock": int(rng.integers(5, 30)),
+            "supplier": SUPPLIERS[rng.integers(len(SUPPLIERS))],
+            "lead_time_days": int(rng.integers(1, 10)),
+            "category": category,
+            "image_url": None,
+            "created_at": created_at,
+        })
+    return products
+
+
+def generate_customers(rng, n, created_at):
+    ids = uuids(rng, n)
+    first = rng.integers(len(FIRST_NAMES), size=n)
+    last = rng.integers(len(LAST_NAMES), size=(n, 2))
+    # A multiplier coprime with 10^7 maps 0..n-1 onto distinct mobile numbers
+    suffix = (np.arange(n, dtype=np.int64) * 7919 + int(rng.integers(10 ** 7))) % 10 ** 7
+    prefix = rng.choice([6, 7], size=n)
+    customers = []
+    for i in range(n):
+        name = f"{FIRST_NAMES[first[i]]} {LAST_NAMES[last[i, 0]]} {LAST_NAMES[last[i, 1]]}"
+        phone = f"591{prefix[i]}{suffix[i]:07d}"
+        customers.append({
+            "id": ids[i],
+            "name": name,
+            "phone": phone,
+            **customer_search_fields({"name": name, "phone": phone}),
+            "email": None,
+            "address": f"{ZONES[rng.integers(len(ZONES))]}, La Paz",
+            "total_purchases": 0.0,
+            "loyalty_points": 0,
+            "preferred_products": [],
+            "created_at": created_at,
+        })
+    return customers
+
+
+# Order chunks are generated in worker processes; catalogs are shipped once
+_catalog = {}
+
+
+def _init_worker(catalog):
+    _catalog.update(catalog)
+
+
+def generate_order_chunk(seed_seq, size):
+    """Build one chunk of orders plus per-customer spend for the loyalty totals."""
+    rng = np.random.default_rng(seed_seq)
+    c = _catalog
+    start, days, now = c["start"], c["days"], c["now"]
+
+    day_weights = WEEKDAY_WEIGHTS[(start.weekday() + np.arange(days)) % 7]
+    day = rng.choice(days, size=size, p=day_weights / day_weights.sum())
+    hour = rng.choice(24, size=size, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    seconds = (day * 86400 + (hour + UTC_OFFSET_HOURS) * 3600 + rng.integers(0, 3600, size)).astype(np.int64)
+    seconds = np.minimum(seconds, int((now - start).total_seconds()) - 1)
+
+    n_items = 1 + np.minimum(rng.poisson(1.0, size), 5)
+    offsets = np.concatenate(([0], np.cumsum(n_items)[:-1]))
+    total_items = int(n_items.sum())
+    product = c["product_rank"][rng.choice(len(c["product_rank"]), size=total_items, p=c["product_p"])]
+    quantity = np.minimum(rng.geometric(0.55, total_items), 24)
+    unit_price = c["sale_price"][product]
+    line_total = np.round(unit_price * quantity, 2)
+    subtotal = np.add.reduceat(line_total, offsets)
+    iva, it = calculate_taxes(subtotal)
+    total = subtotal + iva + it
+
+    customer = c["customer_rank"][rng.choice(len(c["customer_rank"]), size=size, p=c["customer_p"])]
+    cancelled = rng.random(size) < CANCEL_RATE
+    open_status = rng.integers(len(OPEN_STATUSES), size=size)
+    payment = rng.choice(len(PAYMENT_METHODS), size=size, p=PAYMENT_WEIGHTS)
+    delivery_minutes = rng.integers(25, 120, size)
+    ids = uuids(rng, size)
+
+    orders = []
+    for i in range(size):
+        created_at = start + timedelta(seconds=int(seconds[i]))
+        first = offsets[i]
+        items = [
+            {
+                "product_id": c["product_id"][product[j]],
+                "product_name": c["product_name"][product[j]],
+                "quantity": int(quantity[j]),
+                "unit_price": float(unit_price[j]),
+                "total_price": float(line_total[j]),
+            }
+            for j in range(first, first + n_items[i])
+        ]
+        if cancelled[i]:
+            status, delivered_at = "cancelado", None
+        elif now - created_at < timedelta(hours=6):
+            status, delivered_at = OPEN_STATUSES[open_status[i]], None
+        else:
+            status, delivered_at = "entregado", created_at + timedelta(minutes=int(delivery_minutes[i]))
+        cust = customer[i]
+        orders.append({
+            "id": ids[i],
+            "customer_id": c["customer_id"][cust],
+            "customer_name": c["customer_name"][cust],
+            "customer_phone": c["customer_phone"][cust],
+            "items": items,
+            "subtotal": float(subtotal[i]),
+            "iva": float(iva[i]),
+            "it": float(it[i]),
+            "total": float(total[i]),
+            "status": status,
+            "payment_method": PAYMENT_METHODS[payment[i]],
+            "delivery_address": None,
+            "delivery_fee": 0.0,
+            "notes": None,
+            "qr_code": payment_payload({"id": ids[i], "total": float(total[i])}),
+            "created_at": created_at,
+            "delivered_at": delivered_at,
+            "branch_id": DEFAULT_BRANCH_ID,
+            "loyalty_applied": True,
+        })
+
+    spend = np.where(cancelled, 0.0, total)
+    return orders, customer, spend
+
+
+async def insert_chunks(collection, docs, chunk_size, semaphore):
+    async def insert(chunk):
+        async with semaphore:
+            await collection.insert_many(chunk, ordered=False)
+    await asyncio.gather(*(insert(docs[i:i + chunk_size]) for i in range(0, len(docs), chunk_size)))
+
+
+async def generate(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    started = time.monotonic()
+
+    entropy = args.seed
+    if args.append:
+        # Same --seed on a grown database gives a different, still reproducible, stream
+        entropy = [args.seed] + [
+            await db[name].estimated_document_count() for name in ("products", "customers", "orders")
+        ]
+    root = np.random.SeedSequence(entropy)
+    catalog_seq, orders_seq = root.spawn(2)
+    rng = np.random.default_rng(catalog_seq)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    start = (now - timedelta(days=args.days)).replace(hour=0, minute=0, second=0)
+
+    if not args.append:
+        # Everything derived from products, customers or orders goes with them
+        for name in ("products", INVENTORY_COLLECTION, "customers", "orders", SUGGESTIONS_COLLECTION,
+                     "customer_product_counts", HOLDS_COLLECTION, EVENTS_COLLECTION):
+            await db[name].delete_many({})
+        # Archived orders too, or lookups would bring back orders of the wiped dataset
+        await db.orders_archive.drop()
+        shutil.rmtree(ARCHIVE_DIR / "orders", ignore_errors=True)
+        await db[COUNTERS_COLLECTION].delete_one({"_id": "archived_orders"})
+        print("🗑️ Datos anteriores eliminados")
+
+    semaphore = asyncio.Semaphore(args.workers * 2)
+    products = generate_products(rng, args.products, start)
+    customers = generate_customers(rng, args.customers, start)
+    if args.append and (
+        await db.products.count_documents({"id": {"$in": [p["id"] for p in products[:1000]]}}, limit=1)
+        or await db.customers.count_documents({"id": {"$in": [cu["id"] for cu in customers[:1000]]}}, limit=1)
+    ):
+        raise SystemExit("❌ Los ids generados ya existen; use otro --seed")
+
+    await insert_chunks(db.products, products, CHUNK_SIZE, semaphore)
+    await insert_chunks(
+        db[INVENTORY_COLLECTION], [inventory_doc(DEFAULT_BRANCH_ID, p) for p in products], CHUNK_SIZE, semaphore
+    )
+    print(f"📦 {len(products)} productos insertados")
+
+    await insert_chunks(db.customers, customers, CHUNK_SIZE, semaphore)
+    print(f"👥 {len(customers)} clientes insertados")
+
+    catalog = {
+        "start": start,
+        "days": args.days,
+        "now": now,
+        "product_id": [p["id"] for p in products],
+        "product_name": [p["name"] for p in products],
+        "sale_price": np.array([p["sale_price"] for p in products]),
+        "product_rank": rng.permutation(len(products)),
+        "product_p": zipf_weights(len(products), args.product_skew),
+        "customer_id": [cu["id"] for cu in customers],
+        "customer_name": [cu["name"] for cu in customers],
+        "customer_phone": [cu["phone"] for cu in customers],
+        "customer_rank": rng.permutation(len(customers)),
+        "customer_p": zipf_weights(len(customers), args.customer_skew),
+    }
+
+    chunk_sizes = [min(CHUNK_SIZE, args.orders - i) for i in range(0, args.orders, CHUNK_SIZE)]
+    chunk_seeds = orders_seq.spawn(len(chunk_sizes))
+    spend_per_customer = np.zeros(len(customers))
+    orders_per_customer = np.zeros(len(customers), dtype=np.int64)
+    loop = asyncio.get_running_loop()
+    inserted = 0
+
+    # Generate one wave of chunks while the previous wave is being inserted
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(catalog,)) as pool:
+        previous_insert = None
+        for wave in range(0, len(chunk_sizes), args.workers):
+            results = await asyncio.gather(*(
+                loop.run_in_executor(pool, generate_order_chunk, seed, size)
+                for seed, size in zip(chunk_seeds[wave:wave + args.workers], chunk_sizes[wave:wave + args.workers])
+            ))
+            if previous_insert:
+                await previous_insert
+            orders = []
+            for chunk_orders, customer, spend in results:
+                np.add.at(spend_per_customer, customer, spend)
+                np.add.at(orders_per_customer, customer, 1)
+                orders.extend(chunk_orders)
+            previous_insert = asyncio.create_task(insert_chunks(db.orders, orders, CHUNK_SIZE, semaphore))
+            inserted += len(orders)
+            print(f"🛒 {inserted}/{args.orders} pedidos generados ({time.monotonic() - started:.1f}s)")
+        if previous_insert:
+            await previous_insert
+
+    # Keep customer totals consistent with their order history (1 point per 10 Bs)
+    updates = [
+        UpdateOne({"id": customers[i]["id"]}, {"$set": {
+            "total_purchases": round(float(spend_per_customer[i]), 2),
+            "loyalty_points": int(spend_per_customer[i] / 10),
+        }})
+        for i in np.nonzero(orders_per_customer)[0]
+    ]
+    for i in range(0, len(updates), CHUNK_SIZE):
+        await db.customers.bulk_write(updates[i:i + CHUNK_SIZE], ordered=False)
+
+    print(f"✅ {inserted} pedidos insertados en {time.monotonic() - started:.1f}s")
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generar datos sintéticos para Tambar Express")
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=365, help="Días de historial de pedidos")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                        help="Procesos generadores en paralelo")
+    parser.add_argument("--product-skew", type=float, default=1.1, help="Exponente Zipf de productos")
+    parser.add_argument("--customer-skew", type=float, default=0.8, help="Exponente Zipf de clientes")
+    parser.add_argument("--append", action="store_true", help="No borrar los datos existentes")
+    asyncio.run(generate(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
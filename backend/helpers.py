@@ -0,0 +1,37 @@
+"""
+Funciones de cálculo compartidas por la API y los scripts de datos.
+
+Kept free of FastAPI, Motor and settings so scripts such as
+``generate_data.py`` can use them without importing the application.
+"""
+import re
+
+
+def calculate_taxes(subtotal: float):
+    iva = subtotal * 0.13  # 13% IVA
+    it = subtotal * 0.03   # 3% IT
+    return iva, it
+
+
+def calculate_margin(cost_price: float, sale_price: float):
+    return ((sale_price - cost_price) / cost_price * 100) if cost_price > 0 else 0
+
+
+def normalize_phone(phone: str):
+    """Normalize a Bolivian phone number to E.164 (+591 and 8 digits)."""
+    digits = re.sub(r"\D", "", phone or "")
+    if digits.startswith("00"):
+        digits = digits[2:]
+    if len(digits) == 8:
+        digits = "591" + digits
+    if not digits:
+        return None
+    return f"+{digits}"
+
+
+def customer_search_fields(customer: dict):
+    # Derived fields kept in Mongo only, for the indexed lookups
+    return {
+        "phone_e164": normalize_phone(customer.get("phone")),
+        "name_lower": (customer.get("name") or "").strip().lower(),
+    }
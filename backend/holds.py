@@ -0,0 +1,225 @@
+"""
+Reservas de stock (carritos) para Tambar Express.
+
+A hold reserves ``quantity`` units of a product at one branch for a cart
+until ``expires_at``. Each hold is a document in ``stock_holds``, and the
+branch inventory document keeps a ``held`` counter of the units reserved, so
+available-to-promise is ``stock - held``, read from one document without
+aggregating holds. The counter is only raised while enough units are free,
+so two carts can never be promised the same unit.
+
+Expired holds are released by a sweeper (a scheduler job). The TTL index on
+``expires_at`` only deletes holds the sweeper missed for an hour; the held
+units of those, and of any write interrupted between the two documents, are
+corrected by ``reconcile_held``.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from inventory import INVENTORY_COLLECTION, InsufficientStock, claim_available, return_stock, take_stock
+
+HOLDS_COLLECTION = "stock_holds"
+HOLD_TTL_SECONDS = int(os.environ.get("HOLD_TTL_SECONDS", 15 * 60))
+MAX_HOLD_TTL_SECONDS = 2 * 60 * 60
+TTL_INDEX_GRACE_SECONDS = 60 * 60
+RECONCILE_CONFIRM_SECONDS = 2  # Una diferencia se corrige solo si persiste tras esta espera
+
+
+class HoldConflict(Exception):
+    pass
+
+
+def hold_ttl(ttl_seconds=None):
+    return timedelta(seconds=max(1, min(ttl_seconds or HOLD_TTL_SECONDS, MAX_HOLD_TTL_SECONDS)))
+
+
+async def _adjust_held(db, branch_id, product_id, delta):
+    await db[INVENTORY_COLLECTION].update_one(
+        {"branch_id": branch_id, "product_id": product_id},
+        {"$inc": {"held": delta}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+    )
+
+
+async def cart_holds(db, cart_id):
+    """Unexpired holds of a cart."""
+    now = datetime.now(timezone.utc)
+    return await db[HOLDS_COLLECTION].find(
+        {"cart_id": cart_id, "expires_at": {"$gt": now}}, {"_id": 0}
+    ).to_list(None)
+
+
+async def place_hold(db, cart_id, branch_id, product_id, quantity, ttl_seconds=None):
+    """
+    Create the cart's hold on ``product_id`` or set it to ``quantity`` and push
+    its expiry forward. Quantity 0 releases it. Raises ``InsufficientStock``
+    when the extra units are not available and ``HoldConflict`` when the cart
+    belongs to another branch or was changed concurrently.
+    """
+    if quantity <= 0:
+        await release_hold(db, cart_id, product_id)
+        return None
+    now = datetime.now(timezone.utc)
+    existing = None
+    for hold in await db[HOLDS_COLLECTION].find({"cart_id": cart_id}).to_list(None):
+        if hold["product_id"] == product_id:
+            existing = hold
+        elif hold["branch_id"] != branch_id and hold["expires_at"].replace(tzinfo=timezone.utc) > now:
+            raise HoldConflict(f"Cart already holds stock at branch {hold['branch_id']}")
+    if existing and existing["branch_id"] != branch_id:
+        raise HoldConflict(f"Cart already holds stock at branch {existing['branch_id']}")
+
+    # An expired hold not yet swept is still counted in ``held``, so it is reused as is
+    previous = existing["quantity"] if existing else 0
+    delta = quantity - previous
+    if delta > 0:
+        if not await claim_available(db, branch_id, product_id, delta, {"$inc": {"held": delta}}):
+            raise InsufficientStock(product_id)
+    elif delta < 0:
+        await _adjust_held(db, branch_id, product_id, delta)
+
+    fields = {"quantity": quantity, "expires_at": now + hold_ttl(ttl_seconds), "updated_at": now}
+    try:
+        if existing:
+            # Compare-and-set on the quantity the delta was computed from
+            hold = await db[HOLDS_COLLECTION].find_one_and_update(
+                {"_id": existing["_id"], "quantity": previous},
+                {"$set": fields},
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER,
+            )
+        else:
+            hold = {
+                "id": str(uuid.uuid4()),
+                "cart_id": cart_id,
+                "branch_id": branch_id,
+                "product_id": product_id,
+                "created_at": now,
+                **fields,
+            }
+            await db[HOLDS_COLLECTION].insert_one(dict(hold))
+    except DuplicateKeyError:
+        hold = None
+    if hold is None:
+        if delta:
+            await _adjust_held(db, branch_id, product_id, -delta)
+        raise HoldConflict("Cart was modified concurrently, retry")
+    return hold
+
+
+async def release_hold(db, cart_id, product_id):
+    hold = await db[HOLDS_COLLECTION].find_one_and_delete({"cart_id": cart_id, "product_id": product_id})
+    if hold:
+        await _adjust_held(db, hold["branch_id"], hold["product_id"], -hold["quantity"])
+    return hold is not None
+
+
+async def extend_cart(db, cart_id, ttl_seconds=None):
+    """Push back the expiry of every unexpired hold of a cart; returns how many."""
+    now = datetime.now(timezone.utc)
+    result = await db[HOLDS_COLLECTION].update_many(
+        {"cart_id": cart_id, "expires_at": {"$gt": now}},
+        {"$set": {"expires_at": now + hold_ttl(ttl_seconds), "updated_at": now}},
+    )
+    return result.modified_count
+
+
+async def convert_holds(db, holds):
+    """
+    Turn a cart's holds into sold stock at checkout. Holds that expired in
+    the meantime fall back to free stock; if that is not available either,
+    everything converted so far goes back to free stock and
+    ``InsufficientStock`` is raised.
+    """
+    now = datetime.now(timezone.utc)
+    branch_id = holds[0]["branch_id"]
+    converted, missing = {}, {}
+    for hold in holds:
+        claimed = await db[HOLDS_COLLECTION].find_one_and_delete({"id": hold["id"], "expires_at": {"$gt": now}})
+        if claimed:
+            await db[INVENTORY_COLLECTION].update_one(
+                {"branch_id": branch_id, "product_id": claimed["product_id"]},
+                {"$inc": {"stock": -claimed["quantity"], "held": -claimed["quantity"]},
+                 "$set": {"updated_at": now}},
+            )
+            converted[claimed["product_id"]] = claimed["quantity"]
+        else:
+            missing[hold["product_id"]] = hold["quantity"]
+    if missing:
+        try:
+            await take_stock(db, branch_id, missing)
+        except InsufficientStock:
+            await return_stock(db, {(branch_id, product_id): qty for product_id, qty in converted.items()})
+            raise
+    return branch_id
+
+
+async def sweep_expired_holds(db):
+    """Delete expired holds one at a time and give their units back."""
+    now = datetime.now(timezone.utc)
+    released = 0
+    while True:
+        hold = await db[HOLDS_COLLECTION].find_one_and_delete({"expires_at": {"$lte": now}})
+        if not hold:
+            return released
+        await _adjust_held(db, hold["branch_id"], hold["product_id"], -hold["quantity"])
+        released += 1
+
+
+async def _held_mismatches(db, keys=None):
+    """``{(branch_id, product_id): (held, units in holds)}`` where the two differ."""
+    key_filter = [{"branch_id": branch_id, "product_id": product_id} for branch_id, product_id in keys or []]
+    live = {
+        (group["_id"]["branch_id"], group["_id"]["product_id"]): group["held"]
+        for group in await db[HOLDS_COLLECTION].aggregate(
+            ([{"$match": {"$or": key_filter}}] if key_filter else []) + [
+                {"$group": {
+                    "_id": {"branch_id": "$branch_id", "product_id": "$product_id"},
+                    "held": {"$sum": "$quantity"},
+                }},
+            ]
+        ).to_list(None)
+    }
+    if keys is not None:
+        query = {"$or": key_filter}
+    else:
+        # Documents holding units, plus those that should but lost their counter
+        query = {"$or": [{"held": {"$gt": 0}}, {"product_id": {"$in": list({pid for _, pid in live})}}]}
+    mismatches = {}
+    async for entry in db[INVENTORY_COLLECTION].find(query, {"_id": 0, "branch_id": 1, "product_id": 1, "held": 1}):
+        key = (entry["branch_id"], entry["product_id"])
+        held, expected = entry.get("held", 0), live.get(key, 0)
+        if held != expected:
+            mismatches[key] = (held, expected)
+    return mismatches
+
+
+async def reconcile_held(db):
+    """
+    Reset ``held`` to the sum of existing holds where they disagree. A hold
+    being placed or released changes ``held`` and its hold document in two
+    writes, so a difference is only fixed if it is still the same after
+    ``RECONCILE_CONFIRM_SECONDS``; busy products keep changing both numbers,
+    but a leaked difference stays. The fix is a compare-and-set on ``held``,
+    so a hold placed in the meantime is never overwritten.
+    """
+    suspect = await _held_mismatches(db)
+    if not suspect:
+        return 0
+    await asyncio.sleep(RECONCILE_CONFIRM_SECONDS)
+    fixed = 0
+    for (branch_id, product_id), (held, expected) in (await _held_mismatches(db, list(suspect))).items():
+        first = suspect.get((branch_id, product_id))
+        if first is None or first[0] - first[1] != held - expected:
+            continue
+        result = await db[INVENTORY_COLLECTION].update_one(
+            # Documents from before holds have no ``held`` field
+            {"branch_id": branch_id, "product_id": product_id, "held": held if held else {"$in": [0, None]}},
+            {"$set": {"held": expected}},
+        )
+        fixed += result.modified_count
+    return fixed
@@ -0,0 +1,199 @@
+"""
+Inventario por sucursal para Tambar Express.
+
+Stock lives in ``inventory``, one document per ``(branch_id, product_id)``,
+so checkouts at different outlets never write the same document. Stock is
+taken with a conditional ``$inc`` (``stock >= qty``), which also closes the
+read-then-write race of checking stock before decrementing it.
+
+``held`` counts units reserved by cart holds (see ``holds.py``); only
+``stock - held`` can be sold to a new customer.
+
+``Product.stock`` is kept as the total across branches. It is a read model,
+recomputed from ``inventory`` by an outbox consumer instead of being written
+on every checkout.
+
+Queries and indexes on ``inventory`` and ``orders`` lead with ``branch_id``
+so both collections can later be sharded on ``{branch_id: 1, ...}``.
+"""
+import os
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+INVENTORY_COLLECTION = "inventory"
+BRANCHES_COLLECTION = "branches"
+DEFAULT_BRANCH_ID = os.environ.get("DEFAULT_BRANCH_ID", "principal")
+DEFAULT_BRANCH_NAME = "Sucursal Principal"
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id):
+        super().__init__(f"Insufficient stock for {product_id}")
+        self.product_id = product_id
+
+
+def inventory_doc(branch_id, product):
+    return {
+        "branch_id": branch_id,
+        "product_id": product["id"],
+        "stock": product.get("stock", 0),
+        "held": 0,
+        "min_stock": product.get("min_stock", 10),
+        "updated_at": datetime.now(timezone.utc),
+    }
+
+
+def available(entry):
+    """Available-to-promise units of one inventory document."""
+    return entry["stock"] - entry.get("held", 0)
+
+
+def available_at_least(qty):
+    # Documents from before holds have no ``held`` field
+    return {"$expr": {"$gte": [{"$subtract": ["$stock", {"$ifNull": ["$held", 0]}]}, qty]}}
+
+
+async def ensure_default_branch(db):
+    await db[BRANCHES_COLLECTION].update_one(
+        {"id": DEFAULT_BRANCH_ID},
+        {"$setOnInsert": {
+            "id": DEFAULT_BRANCH_ID,
+            "name": DEFAULT_BRANCH_NAME,
+            "address": None,
+            "created_at": datetime.now(timezone.utc),
+        }},
+        upsert=True,
+    )
+
+
+async def seed_branch_stock(db, product_ids=None):
+    """
+    Give products that have no inventory anywhere a default-branch document
+    holding their ``Product.stock``; returns how many were created.
+    """
+    query = {} if product_ids is None else {"id": {"$in": list(product_ids)}}
+    stocked_query = {} if product_ids is None else {"product_id": {"$in": list(product_ids)}}
+    stocked = set(await db[INVENTORY_COLLECTION].distinct("product_id", stocked_query))
+    products = [
+        product
+        async for product in db.products.find(query, {"_id": 0, "id": 1, "stock": 1, "min_stock": 1})
+        if product["id"] not in stocked
+    ]
+    if not products:
+        return 0
+    # $setOnInsert so a concurrent seed or checkout is never overwritten
+    result = await db[INVENTORY_COLLECTION].bulk_write([
+        UpdateOne(
+            {"branch_id": DEFAULT_BRANCH_ID, "product_id": product["id"]},
+            {"$setOnInsert": inventory_doc(DEFAULT_BRANCH_ID, product)},
+            upsert=True,
+        )
+        for product in products
+    ], ordered=False)
+    return result.upserted_count
+
+
+async def claim_available(db, branch_id, product_id, qty, update):
+    """Apply ``update`` only if ``qty`` units are available; returns whether it did."""
+    query = {"branch_id": branch_id, "product_id": product_id, **available_at_least(qty)}
+    update = {**update, "$set": {"updated_at": datetime.now(timezone.utc)}}
+    result = await db[INVENTORY_COLLECTION].update_one(query, update)
+    if result.modified_count == 0 and branch_id == DEFAULT_BRANCH_ID:
+        # Products inserted directly (seed scripts) get their document on first use
+        if await seed_branch_stock(db, [product_id]):
+            result = await db[INVENTORY_COLLECTION].update_one(query, update)
+    return result.modified_count == 1
+
+
+async def take_stock(db, branch_id, quantities):
+    """
+    Decrement ``{product_id: qty}`` at one branch, all or nothing. Raises
+    ``InsufficientStock`` after giving back what was already taken.
+    """
+    taken = {}
+    for product_id, qty in quantities.items():
+        if not await claim_available(db, branch_id, product_id, qty, {"$inc": {"stock": -qty}}):
+            await return_stock(db, {(branch_id, pid): n for pid, n in taken.items()})
+            raise InsufficientStock(product_id)
+        taken[product_id] = qty
+
+
+async def return_stock(db, quantities, session=None):
+    """Increment stock for ``{(branch_id, product_id): qty}`` in one bulk write."""
+    if not quantities:
+        return
+    now = datetime.now(timezone.utc)
+    await db[INVENTORY_COLLECTION].bulk_write([
+        UpdateOne(
+            {"branch_id": branch_id, "product_id": product_id},
+            {"$inc": {"stock": qty}, "$set": {"updated_at": now}},
+        )
+        for (branch_id, product_id), qty in quantities.items()
+    ], ordered=False, session=session)
+
+
+async def refresh_product_totals(db, product_ids):
+    """Recompute ``Product.stock`` as the sum over branches for ``product_ids``."""
+    product_ids = list(set(product_ids))
+    if not product_ids:
+        return 0
+    totals = await db[INVENTORY_COLLECTION].aggregate([
+        {"$match": {"product_id": {"$in": product_ids}}},
+        {"$group": {"_id": "$product_id", "stock": {"$sum": "$stock"}}},
+    ]).to_list(None)
+    if not totals:
+        return 0
+    await db.products.bulk_write(
+        [UpdateOne({"id": total["_id"]}, {"$set": {"stock": total["stock"]}}) for total in totals],
+        ordered=False,
+    )
+    return len(totals)
+
+
+async def branch_low_stock(db, branch_id):
+    """Inventory documents of ``branch_id`` below their branch minimum."""
+    return await db[INVENTORY_COLLECTION].find(
+        {"branch_id": branch_id, "$expr": {"$lt": ["$stock", "$min_stock"]}}, {"_id": 0}
+    ).to_list(None)
+
+
+def inventory_report_pipeline(horizon, branch_id=None):
+    """
+    One aggregation valuing stock per category. Without ``branch_id`` it
+    reads ``Product.stock`` (the total across branches); with it, the
+    branch's inventory documents joined to their products.
+    """
+    stages = []
+    if branch_id:
+        stages = [
+            {"$match": {"branch_id": branch_id}},
+            {"$lookup": {"from": "products", "localField": "product_id", "foreignField": "id", "as": "product"}},
+            {"$unwind": "$product"},
+            {"$project": {
+                "stock": 1,
+                "min_stock": 1,
+                "category": "$product.category",
+                "cost_price": "$product.cost_price",
+                "sale_price": "$product.sale_price",
+                "expiry_at": "$product.expiry_at",
+            }},
+        ]
+    expiring = {"$and": [
+        {"$gt": ["$stock", 0]},
+        # Missing dates sort before any date, so exclude them explicitly
+        {"$ne": [{"$ifNull": ["$expiry_at", None]}, None]},
+        {"$lte": ["$expiry_at", horizon]},
+    ]}
+    return stages + [
+        {"$group": {
+            "_id": "$category",
+            "products": {"$sum": 1},
+            "units": {"$sum": "$stock"},
+            "cost_value": {"$sum": {"$multiply": ["$stock", "$cost_price"]}},
+            "sale_value": {"$sum": {"$multiply": ["$stock", "$sale_price"]}},
+            "low_stock": {"$sum": {"$cond": [{"$lt": ["$stock", "$min_stock"]}, 1, 0]}},
+            "expiring": {"$sum": {"$cond": [expiring, 1, 0]}},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
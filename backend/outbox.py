@@ -0,0 +1,318 @@
+"""
+Outbox de eventos de dominio para consumidores incrementales.
+
+Every order, product and status change appends an event to ``domain_events``
+with a monotonic ``seq``, inside the same transaction as the write when the
+Mongo deployment supports transactions (replica set or mongos). The
+dispatcher tails the collection by ``seq`` and feeds each registered consumer,
+storing its checkpoint in ``outbox_checkpoints`` only after the handler
+succeeds, so delivery is at-least-once and a consumer can be replayed by
+moving its checkpoint back.
+
+Only one worker dispatches at a time: it holds a lease in ``scheduler_locks``
+(as the scheduler's jobs do) and renews it while running. Checkpoints are
+saved with a compare-and-set, so a worker that lost the lease, or a replay
+issued on another worker, is never overwritten.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from scheduler import LOCKS_COLLECTION
+
+EVENTS_COLLECTION = "domain_events"
+CHECKPOINTS_COLLECTION = "outbox_checkpoints"
+COUNTERS_COLLECTION = "counters"
+
+BATCH_SIZE = 200
+POLL_SECONDS = 1.0
+GAP_TIMEOUT_SECONDS = 5.0  # Espera máxima por una secuencia aún sin confirmar
+SKIPPED_RETRY_SECONDS = 10 * 60  # Secuencias saltadas que se siguen buscando
+LEASE_ID = "outbox_dispatcher"
+LEASE_SECONDS = 30
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    def __init__(self, client, db):
+        self.client = client
+        self.db = db
+        self.transactions = False
+        self.appended = asyncio.Event()
+
+    async def detect_transactions(self):
+        hello = await self.client.admin.command("hello")
+        self.transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        return self.transactions
+
+    @asynccontextmanager
+    async def unit(self):
+        """Yield a session in a transaction, or None on a standalone server."""
+        if not self.transactions:
+            yield None
+            return
+        async with await self.client.start_session() as session:
+            async with session.start_transaction():
+                yield session
+
+    async def _next_seq(self, count):
+        # Allocated outside the transaction: concurrent writers would otherwise
+        # abort each other on the counter document. Aborted writes leave gaps,
+        # which the dispatcher skips after GAP_TIMEOUT_SECONDS and keeps
+        # looking for during SKIPPED_RETRY_SECONDS.
+        counter = await self.db[COUNTERS_COLLECTION].find_one_and_update(
+            {"_id": EVENTS_COLLECTION},
+            {"$inc": {"seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter["seq"] - count + 1
+
+    async def record(self, event_type, aggregate_id, payload, session=None):
+        await self.record_many([(event_type, aggregate_id, payload)], session=session)
+
+    async def record_many(self, events, session=None):
+        """Append ``(event_type, aggregate_id, payload)`` tuples in order."""
+        if not events:
+            return
+        first = await self._next_seq(len(events))
+        now = datetime.now(timezone.utc)
+        await self.db[EVENTS_COLLECTION].insert_many(
+            [
+                {
+                    "seq": first + offset,
+                    "type": event_type,
+                    "aggregate_id": aggregate_id,
+                    "payload": payload,
+                    "created_at": now,
+                }
+                for offset, (event_type, aggregate_id, payload) in enumerate(events)
+            ],
+            session=session,
+        )
+        self.appended.set()
+
+
+class Consumer:
+    def __init__(self, name, handler, event_types=None):
+        self.name = name
+        self.handler = handler
+        self.event_types = set(event_types) if event_types else None
+        self.checkpoint = 0
+        self.saved = 0  # Checkpoint as last read from or written to Mongo
+        self.skipped = {}  # seq -> when it was skipped
+        self.processed = 0
+        self.failures = 0
+        self.last_error = None
+        self.gap_seen_at = None
+
+
+class OutboxDispatcher:
+    def __init__(self, db, outbox):
+        self.db = db
+        self.outbox = outbox
+        self.consumers = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.leader = False
+        self._renew_at = 0.0
+        self._task = None
+
+    def register(self, name, handler, event_types=None):
+        """Register ``async handler(event)`` under a durable consumer name."""
+        self.consumers[name] = Consumer(name, handler, event_types)
+
+    def consumer(self, name, event_types=None):
+        def decorator(handler):
+            self.register(name, handler, event_types)
+            return handler
+        return decorator
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.leader:
+            # Let another worker take over without waiting for the lease to expire
+            await self.db[LOCKS_COLLECTION].update_one(
+                {"_id": LEASE_ID, "owner": self.owner},
+                {"$set": {"expires_at": datetime.now(timezone.utc)}},
+            )
+            self.leader = False
+
+    async def replay(self, name, from_seq=0):
+        """Move a consumer's checkpoint back so it reprocesses later events."""
+        await self.db[CHECKPOINTS_COLLECTION].update_one(
+            {"_id": name},
+            {"$set": {"seq": max(from_seq - 1, 0), "skipped": [], "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+        # The leader reloads checkpoints when it renews its lease; here that is now
+        self._renew_at = 0.0
+        self.outbox.appended.set()
+
+    async def _acquire(self):
+        """Take or renew the dispatcher lease; returns whether this worker holds it."""
+        now = datetime.now(timezone.utc)
+        try:
+            await self.db[LOCKS_COLLECTION].update_one(
+                {"_id": LEASE_ID, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=LEASE_SECONDS)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def _load_checkpoints(self, names=None):
+        names = list(names or self.consumers)
+        async for doc in self.db[CHECKPOINTS_COLLECTION].find({"_id": {"$in": names}}):
+            consumer = self.consumers[doc["_id"]]
+            if doc["seq"] != consumer.checkpoint:
+                consumer.gap_seen_at = None
+            consumer.checkpoint = consumer.saved = doc["seq"]
+            consumer.skipped = {
+                entry["seq"]: entry["at"].replace(tzinfo=timezone.utc) for entry in doc.get("skipped", [])
+            }
+
+    async def _run(self):
+        while True:
+            if time.monotonic() >= self._renew_at:
+                self._renew_at = time.monotonic() + LEASE_SECONDS / 3
+                try:
+                    self.leader = await self._acquire()
+                    if self.leader:
+                        # Checkpoints may have been advanced by the previous leader or replayed
+                        await self._load_checkpoints()
+                except Exception:
+                    self.leader = False
+                    logger.exception("Outbox dispatcher lease failed")
+            if not self.leader:
+                await asyncio.sleep(max(self._renew_at - time.monotonic(), 0))
+                continue
+
+            self.outbox.appended.clear()
+            busy = False
+            for consumer in self.consumers.values():
+                try:
+                    busy = await self._dispatch(consumer) or busy
+                except Exception as exc:  # Keep the loop alive; retry on the next tick
+                    consumer.failures += 1
+                    consumer.last_error = str(exc)
+                    logger.exception("Outbox consumer %s failed", consumer.name)
+            if busy:
+                continue
+            try:
+                await asyncio.wait_for(self.outbox.appended.wait(), timeout=POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, consumer):
+        skipped = dict(consumer.skipped)
+        advanced = 0
+        try:
+            await self._retry_skipped(consumer)
+            events = await self.db[EVENTS_COLLECTION].find(
+                {"seq": {"$gt": consumer.checkpoint}}, {"_id": 0}
+            ).sort("seq", 1).limit(BATCH_SIZE).to_list(BATCH_SIZE)
+            for event in events:
+                expected = consumer.checkpoint + 1
+                # A hole means a lower seq has not committed yet; move past it only after a while
+                if event["seq"] != expected:
+                    if consumer.gap_seen_at is None:
+                        consumer.gap_seen_at = time.monotonic()
+                    if time.monotonic() - consumer.gap_seen_at < GAP_TIMEOUT_SECONDS:
+                        break
+                    now = datetime.now(timezone.utc)
+                    consumer.skipped.update({seq: now for seq in range(expected, event["seq"])})
+                consumer.gap_seen_at = None
+                await self._handle(consumer, event)
+                consumer.checkpoint = event["seq"]
+                advanced += 1
+        finally:
+            if advanced or consumer.skipped != skipped:
+                await self._save_checkpoint(consumer)
+        return advanced == BATCH_SIZE
+
+    async def _handle(self, consumer, event):
+        if consumer.event_types is None or event["type"] in consumer.event_types:
+            await consumer.handler(event)
+            consumer.processed += 1
+
+    async def _retry_skipped(self, consumer):
+        """Deliver skipped seqs that committed late; give up on them after SKIPPED_RETRY_SECONDS."""
+        if not consumer.skipped:
+            return
+        late = await self.db[EVENTS_COLLECTION].find(
+            {"seq": {"$in": list(consumer.skipped)}}, {"_id": 0}
+        ).sort("seq", 1).to_list(None)
+        for event in late:
+            await self._handle(consumer, event)
+            del consumer.skipped[event["seq"]]
+        horizon = datetime.now(timezone.utc) - timedelta(seconds=SKIPPED_RETRY_SECONDS)
+        for seq, skipped_at in list(consumer.skipped.items()):
+            if skipped_at < horizon:
+                logger.warning("Outbox consumer %s gave up on seq %s", consumer.name, seq)
+                del consumer.skipped[seq]
+
+    async def _save_checkpoint(self, consumer):
+        try:
+            # Compare-and-set on the stored seq: only this dispatcher's own last write may be replaced
+            await self.db[CHECKPOINTS_COLLECTION].update_one(
+                {"_id": consumer.name, "seq": consumer.saved},
+                {"$set": {
+                    "seq": consumer.checkpoint,
+                    "skipped": [{"seq": seq, "at": at} for seq, at in sorted(consumer.skipped.items())],
+                    "updated_at": datetime.now(timezone.utc),
+                }},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Moved by a replay or by another dispatcher; continue from the stored position
+            logger.warning("Outbox checkpoint of %s changed elsewhere, reloading", consumer.name)
+            await self._load_checkpoints([consumer.name])
+            return
+        consumer.saved = consumer.checkpoint
+
+    async def stats(self):
+        head = await self.db[COUNTERS_COLLECTION].find_one({"_id": EVENTS_COLLECTION})
+        last_seq = head["seq"] if head else 0
+        # Read from Mongo: on workers that do not hold the lease the in-memory checkpoints are stale
+        stored = {
+            doc["_id"]: doc
+            async for doc in self.db[CHECKPOINTS_COLLECTION].find({"_id": {"$in": list(self.consumers)}})
+        }
+        lease = await self.db[LOCKS_COLLECTION].find_one({"_id": LEASE_ID})
+        consumers = {}
+        for consumer in self.consumers.values():
+            checkpoint = stored.get(consumer.name, {}).get("seq", 0)
+            consumers[consumer.name] = {
+                "checkpoint": checkpoint,
+                "lag": max(last_seq - checkpoint, 0),
+                "skipped": len(stored.get(consumer.name, {}).get("skipped", [])),
+                "processed": consumer.processed,
+                "failures": consumer.failures,
+                "last_error": consumer.last_error,
+            }
+        return {
+            "last_seq": last_seq,
+            "transactions": self.outbox.transactions,
+            "dispatcher": lease["owner"] if lease else None,
+            "leader": self.leader,
+            "consumers": consumers,
+        }
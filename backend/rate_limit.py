@@ -0,0 +1,162 @@
+"""
+Limitación de tráfico y descarte de carga para la API.
+
+Two layers, both in-process:
+
+* Token buckets per WhatsApp phone number plus one global bucket for chat
+  traffic, answering 429 with ``Retry-After`` when a sender is spamming.
+* An admission controller with a fixed number of request slots (roughly the
+  Mongo pool size). Waiters are served by priority class, so checkout and
+  order-status requests always get the next free slot ahead of chat traffic.
+  Lower classes only wait a short time and are shed with 503 instead of
+  letting latency grow without bound.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict
+
+# Clases de prioridad (menor número = mayor prioridad)
+CRITICAL = 0
+NORMAL = 1
+CHAT = 2
+PRIORITY_NAMES = {CRITICAL: "critical", NORMAL: "normal", CHAT: "chat"}
+
+MAX_CONCURRENT_REQUESTS = 64
+MAX_WAIT_SECONDS = {CRITICAL: 30.0, NORMAL: 2.0, CHAT: 0.25}
+MAX_QUEUED = {CRITICAL: 1000, NORMAL: 200, CHAT: 50}
+
+PHONE_RATE_PER_SECOND = 0.5  # Un mensaje cada 2 segundos en promedio
+PHONE_BURST = 5
+GLOBAL_CHAT_RATE_PER_SECOND = 50.0
+GLOBAL_CHAT_BURST = 100
+MAX_TRACKED_PHONES = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def try_acquire(self, tokens=1.0):
+        """Take tokens if available; otherwise return the seconds until they are."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True, 0.0
+        return False, (tokens - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Per-key token buckets behind one global bucket."""
+
+    def __init__(self, rate=PHONE_RATE_PER_SECOND, burst=PHONE_BURST,
+                 global_rate=GLOBAL_CHAT_RATE_PER_SECOND, global_burst=GLOBAL_CHAT_BURST,
+                 max_keys=MAX_TRACKED_PHONES):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.limited = 0
+
+    def check(self, key):
+        """Return (allowed, retry_after_seconds) for one request from ``key``."""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            # Least recently seen senders are forgotten; they start with a full bucket
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+
+        allowed, retry_after = bucket.try_acquire()
+        if allowed:
+            allowed, retry_after = self.global_bucket.try_acquire()
+            if not allowed:
+                # Give the sender its token back, the global limit rejected it
+                bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+        if not allowed:
+            self.limited += 1
+        return allowed, retry_after
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Server overloaded")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Fixed pool of request slots handed out in priority order."""
+
+    def __init__(self, slots=MAX_CONCURRENT_REQUESTS):
+        self.slots = slots
+        self.in_flight = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self.queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.admitted = {priority: 0 for priority in PRIORITY_NAMES}
+        self.shed = {priority: 0 for priority in PRIORITY_NAMES}
+
+    async def acquire(self, priority):
+        # Drop waiters that timed out or disconnected
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self.in_flight < self.slots and not self._waiters:
+            self.in_flight += 1
+            self.admitted[priority] += 1
+            return
+        if self.queued[priority] >= MAX_QUEUED[priority]:
+            self.shed[priority] += 1
+            raise Overloaded(self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future]
+        heapq.heappush(self._waiters, entry)
+        self.queued[priority] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=MAX_WAIT_SECONDS[priority])
+        except asyncio.TimeoutError:
+            # Unless the slot was handed over just as the timeout fired
+            if not future.done():
+                future.cancel()
+                self.shed[priority] += 1
+                raise Overloaded(self._retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        finally:
+            self.queued[priority] -= 1
+        self.admitted[priority] += 1
+
+    def release(self):
+        # Hand the slot straight to the best waiter so it cannot be stolen
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _retry_after(self):
+        return max(1, math.ceil(len(self._waiters) / max(self.slots, 1)))
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "in_flight": self.in_flight,
+            "queued": {PRIORITY_NAMES[p]: n for p, n in self.queued.items()},
+            "admitted": {PRIORITY_NAMES[p]: n for p, n in self.admitted.items()},
+            "shed": {PRIORITY_NAMES[p]: n for p, n in self.shed.items()},
+        }
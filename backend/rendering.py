@@ -0,0 +1,224 @@
+"""
+Renderizado de QR de pago y facturas imprimibles.
+
+Rendering is CPU-bound, so it runs in a process pool instead of on the
+asyncio loop. Output is stored in a content-addressed cache on disk: the key
+is a hash of everything that affects the bytes, so an order that has not
+changed is served straight from the file, and concurrent requests for the
+same key share one render. The least recently used files are evicted once
+the cache grows past ``RENDER_CACHE_MAX_BYTES``.
+
+QR images need the ``segno`` package, imported only inside the workers.
+"""
+import asyncio
+import functools
+import hashlib
+import html
+import io
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+RENDER_CACHE_DIR = Path(os.environ.get("RENDER_CACHE_DIR", Path(__file__).parent / "render_cache"))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 2))
+RENDERER_VERSION = "1"  # Cambiar para invalidar la caché al modificar las plantillas
+
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml", "html": "text/html; charset=utf-8"}
+
+BUSINESS_NAME = "TAMBAR EXPRESS"
+BUSINESS_NIT = os.environ.get("BUSINESS_NIT", "0000000000")
+BUSINESS_ADDRESS = "La Paz, Bolivia"
+
+
+# Fields printed on the invoice; status changes must not invalidate the cache
+INVOICE_FIELDS = ("id", "customer_name", "customer_phone", "items", "subtotal", "iva", "it",
+                  "delivery_fee", "total", "payment_method", "created_at")
+
+
+def payment_payload(order):
+    """Text encoded in the payment QR for an order."""
+    return f"TAMBAR|{order['id']}|BOB|{order['total']:.2f}"
+
+
+def invoice_content(order):
+    return {field: order.get(field) for field in INVOICE_FIELDS}
+
+
+# Worker-side renderers (run in the process pool)
+
+def _qr(payload):
+    import segno
+    return segno.make(payload, error="m")
+
+
+def render_qr(payload, fmt):
+    buffer = io.BytesIO()
+    _qr(payload).save(buffer, kind=fmt, scale=8, border=2)
+    return buffer.getvalue()
+
+
+def render_invoice(order):
+    buffer = io.BytesIO()
+    _qr(payment_payload(order)).save(buffer, kind="svg", scale=4, border=1, xmldecl=False)
+    qr_svg = buffer.getvalue().decode("utf-8")
+
+    esc = html.escape
+    rows = "".join(
+        f"<tr><td>{esc(item['product_name'])}</td><td class='n'>{item['quantity']}</td>"
+        f"<td class='n'>{item['unit_price']:.2f}</td><td class='n'>{item['total_price']:.2f}</td></tr>"
+        for item in order["items"]
+    )
+    delivery = (
+        f"<tr><td colspan='3'>Envío</td><td class='n'>{order['delivery_fee']:.2f}</td></tr>"
+        if order.get("delivery_fee") else ""
+    )
+    return f"""<!DOCTYPE html>
+<html lang="es"><head><meta charset="utf-8">
+<title>Factura {esc(order['id'][:8])}</title>
+<style>
+body{{font-family:Arial,sans-serif;max-width:720px;margin:24px auto;color:#111}}
+table{{width:100%;border-collapse:collapse}}td,th{{padding:4px 6px;border-bottom:1px solid #ddd}}
+.n{{text-align:right}}.tot td{{font-weight:bold}}header{{display:flex;justify-content:space-between}}
+@media print{{body{{margin:0}}}}
+</style></head><body>
+<header><div><h2>{BUSINESS_NAME}</h2><div>NIT: {esc(BUSINESS_NIT)}</div><div>{BUSINESS_ADDRESS}</div></div>
+<div>{qr_svg}</div></header>
+<p><b>Factura N°:</b> {esc(order['id'])}<br>
+<b>Fecha:</b> {order['created_at']:%d/%m/%Y %H:%M}<br>
+<b>Cliente:</b> {esc(order['customer_name'])} &middot; {esc(order['customer_phone'])}<br>
+<b>Método de pago:</b> {esc(order.get('payment_method') or '-')}</p>
+<table><thead><tr><th>Producto</th><th class='n'>Cant.</th><th class='n'>P. Unit. (Bs.)</th>
+<th class='n'>Total (Bs.)</th></tr></thead><tbody>{rows}
+<tr><td colspan='3'>Subtotal</td><td class='n'>{order['subtotal']:.2f}</td></tr>
+<tr><td colspan='3'>IVA (13%)</td><td class='n'>{order['iva']:.2f}</td></tr>
+<tr><td colspan='3'>IT (3%)</td><td class='n'>{order['it']:.2f}</td></tr>{delivery}
+<tr class='tot'><td colspan='3'>TOTAL</td><td class='n'>{order['total']:.2f}</td></tr>
+</tbody></table></body></html>""".encode("utf-8")
+
+
+class RenderCache:
+    """Content-addressed files on disk with LRU eviction by total size."""
+
+    def __init__(self, directory=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES, workers=RENDER_WORKERS):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._pool = None
+        self._entries = None  # key -> (path, size), oldest first
+        self._size = 0
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(kind, fmt, content):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([RENDERER_VERSION, kind, fmt, content], sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _path(self, key, fmt):
+        return self.directory / key[:2] / f"{key}.{fmt}"
+
+    def _scan(self):
+        # Rebuild recency from mtimes, which hits refresh
+        files = sorted((p.stat().st_mtime, p) for p in self.directory.glob("*/*") if p.suffix != ".tmp")
+        return [(path.stem, path, path.stat().st_size) for _, path in files]
+
+    @staticmethod
+    def _read(path):
+        data = path.read_bytes()
+        os.utime(path)
+        return data
+
+    @staticmethod
+    def _write(path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+
+    @staticmethod
+    def _unlink(paths):
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def _record(self, key, path, size):
+        """Track a new file and return the paths evicted to stay under the limit."""
+        self._entries[key] = (path, size)
+        self._size += size
+        evicted = []
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, (old_path, old_size) = self._entries.popitem(last=False)
+            self._size -= old_size
+            evicted.append(old_path)
+        return evicted
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    async def get(self, key, fmt, render, *args):
+        """Return cached bytes for ``key`` or produce them with ``render(*args)`` in the pool."""
+        loop = asyncio.get_running_loop()
+        if self._entries is None:
+            files = await loop.run_in_executor(None, self._scan)
+            if self._entries is None:
+                self._entries = OrderedDict()
+                evicted = []
+                for cached_key, path, size in files:
+                    evicted += self._record(cached_key, path, size)
+                if evicted:
+                    await loop.run_in_executor(None, self._unlink, evicted)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            path, size = self._entries[key]
+            try:
+                return await loop.run_in_executor(None, self._read, path)
+            except FileNotFoundError:
+                if self._entries.pop(key, None):
+                    self._size -= size
+
+        if key in self._inflight:
+            self.hits += 1
+            task = self._inflight[key]
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._render(key, fmt, render, *args))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._finish, key))
+        # A caller that disconnects does not cancel the render the others wait on
+        return await asyncio.shield(task)
+
+    async def _render(self, key, fmt, render, *args):
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self._executor(), render, *args)
+        path = self._path(key, fmt)
+        await loop.run_in_executor(None, self._write, path, data)
+        evicted = self._record(key, path, len(data))
+        if evicted:
+            await loop.run_in_executor(None, self._unlink, evicted)
+        return data
+
+    def _finish(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # Every waiter may have gone; mark a failure as retrieved
+            task.exception()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self):
+        return {
+            "entries": len(self._entries or {}),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
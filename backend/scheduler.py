@@ -0,0 +1,218 @@
+"""
+Planificador de tareas en segundo plano para Tambar Express.
+
+Jobs are declared with a five-field cron expression (minute hour day month
+weekday, in UTC) and started with the app. Every uvicorn worker runs the same
+timers; a lease document per job in ``scheduler_locks`` makes sure each
+scheduled occurrence ("slot") runs on exactly one worker. The lease is renewed
+while the job runs, so a worker that dies mid-run lets another one take the
+slot over once the lease expires. Every run is recorded in ``scheduler_runs``.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+LOCKS_COLLECTION = "scheduler_locks"
+RUNS_COLLECTION = "scheduler_runs"
+LEASE_SECONDS = 60
+RUNS_RETENTION_SECONDS = 30 * 24 * 60 * 60  # Historial de ejecuciones (índice TTL)
+
+logger = logging.getLogger(__name__)
+
+
+class CronSchedule:
+    """Minimal cron: ``*``, ``*/n``, ``a-b``, ``a-b/n`` and comma lists."""
+
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.RANGES)
+        )
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for item in field.split(","):
+            step = 1
+            if "/" in item:
+                item, step = item.split("/")
+                step = int(step)
+            if item == "*":
+                start, end = low, high
+            elif "-" in item:
+                start, end = (int(v) for v in item.split("-"))
+            else:
+                start = end = int(item)
+            if start < low or end > high:
+                raise ValueError(f"Cron value out of range in {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def next_after(self, moment):
+        """First matching minute strictly after ``moment``."""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 4)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                year = candidate.year + candidate.month // 12
+                candidate = candidate.replace(year=year, month=candidate.month % 12 + 1, day=1, hour=0, minute=0)
+                continue
+            # Cron weekdays count from Sunday = 0
+            if candidate.day not in self.days or (candidate.weekday() + 1) % 7 not in self.weekdays:
+                candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if candidate.hour not in self.hours:
+                candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+                continue
+            if candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+                continue
+            return candidate
+        raise ValueError(f"Cron expression never matches: {self.expression!r}")
+
+
+class Job:
+    def __init__(self, name, func, schedule, jitter_seconds=0):
+        self.name = name
+        self.func = func
+        self.schedule = CronSchedule(schedule)
+        self.jitter_seconds = jitter_seconds
+        self.next_run = None
+        self.running = False
+
+
+class Scheduler:
+    def __init__(self, db):
+        self.db = db
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.jobs = {}
+        self._tasks = []
+
+    def job(self, name, schedule, jitter_seconds=30):
+        """Decorator registering ``async func()``; its return value is stored with the run."""
+        def decorator(func):
+            self.jobs[name] = Job(name, func, schedule, jitter_seconds)
+            return func
+        return decorator
+
+    async def start(self):
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._loop(job)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _loop(self, job):
+        while True:
+            now = datetime.now(timezone.utc)
+            job.next_run = job.schedule.next_after(now)
+            delay = (job.next_run - now).total_seconds() + random.uniform(0, job.jitter_seconds)
+            await asyncio.sleep(delay)
+            try:
+                await self.run(job.name, slot=job.next_run)
+            except Exception:
+                logger.exception("Scheduled job %s failed", job.name)
+
+    async def _claim(self, job, slot):
+        now = datetime.now(timezone.utc)
+        try:
+            await self.db[LOCKS_COLLECTION].update_one(
+                {
+                    "_id": job.name,
+                    # An earlier slot only once its run finished or stopped renewing the lease;
+                    # the same slot only if its owner stopped renewing it
+                    "$or": [
+                        {"slot": {"$lt": slot}, "finished": True},
+                        {"slot": {"$lte": slot}, "finished": False, "expires_at": {"$lt": now}},
+                    ],
+                },
+                {"$set": {
+                    "slot": slot,
+                    "owner": self.owner,
+                    "finished": False,
+                    "started_at": now,
+                    "expires_at": now + timedelta(seconds=LEASE_SECONDS),
+                }},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def _renew(self, job, slot):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            await self.db[LOCKS_COLLECTION].update_one(
+                {"_id": job.name, "slot": slot, "owner": self.owner},
+                {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=LEASE_SECONDS)}},
+            )
+
+    async def run(self, name, slot=None, func=None):
+        """
+        Run one occurrence of ``name`` if this worker wins its lease. ``func``
+        replaces the job's function for this run, e.g. a manual run with
+        arguments, while keeping the job's lease.
+        """
+        job = self.jobs[name]
+        slot = slot or datetime.now(timezone.utc)
+        if not await self._claim(job, slot):
+            return None
+
+        renew = asyncio.create_task(self._renew(job, slot))
+        started = time.monotonic()
+        started_at = datetime.now(timezone.utc)
+        status, result, error = "success", None, None
+        job.running = True
+        try:
+            result = await (func or job.func)()
+        except Exception as exc:
+            status, error = "error", str(exc)
+            logger.exception("Job %s failed", name)
+        finally:
+            job.running = False
+            renew.cancel()
+            duration_ms = round((time.monotonic() - started) * 1000, 1)
+            await self.db[LOCKS_COLLECTION].update_one(
+                {"_id": name, "slot": slot, "owner": self.owner},
+                {"$set": {"finished": True, "expires_at": datetime.now(timezone.utc)}},
+            )
+            run = {
+                "id": str(uuid.uuid4()),
+                "job": name,
+                "slot": slot,
+                "owner": self.owner,
+                "status": status,
+                "result": result,
+                "error": error,
+                "started_at": started_at,
+                "duration_ms": duration_ms,
+            }
+            await self.db[RUNS_COLLECTION].insert_one(dict(run))
+        return run
+
+    def describe(self):
+        return [
+            {
+                "name": job.name,
+                "schedule": job.schedule.expression,
+                "jitter_seconds": job.jitter_seconds,
+                "next_run": job.next_run,
+                "running": job.running,
+            }
+            for job in self.jobs.values()
+        ]
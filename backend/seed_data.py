@@ -14,6 +14,8 @@ from dotenv import load_dotenv
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+from helpers import customer_search_fields
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
@@ -273,8 +275,10 @@ async def seed_database():
     await db.products.insert_many(SAMPLE_PRODUCTS)
     print(f"📦 {len(SAMPLE_PRODUCTS)} productos insertados")
     
-    # Insert customers
-    await db.customers.insert_many(SAMPLE_CUSTOMERS)
+    # Insert customers, with the derived fields the phone and name lookups query
+    await db.customers.insert_many([
+        {**customer, **customer_search_fields(customer)} for customer in SAMPLE_CUSTOMERS
+    ])
     print(f"👥 {len(SAMPLE_CUSTOMERS)} clientes insertados")
     
     # Insert WhatsApp messages
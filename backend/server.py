@@ -1,30 +1,85 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
 import logging
+import math
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, create_model
+from typing import List, Optional, Tuple
+from functools import lru_cache
+import base64
+import re
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 
 ROOT_DIR = Path(__file__).parent
+# Before the local imports: they read their settings from the environment when imported
 load_dotenv(ROOT_DIR / '.env')
 
+from archive import (  # noqa: E402
+    RETENTION_DAYS, archive_collection, archived_before, archived_count, find_archived, find_with_archive
+)
+from caching import SingleFlightCache, cache_stats  # noqa: E402
+from events import TOPICS, event_bus, stream_events  # noqa: E402
+from forecasting import SUGGESTIONS_COLLECTION, refresh_reorder_suggestions  # noqa: E402
+from helpers import calculate_margin, calculate_taxes, customer_search_fields, normalize_phone  # noqa: E402
+from holds import (  # noqa: E402
+    HOLD_TTL_SECONDS, HOLDS_COLLECTION, TTL_INDEX_GRACE_SECONDS, HoldConflict, cart_holds, convert_holds, extend_cart, place_hold,
+    reconcile_held, release_hold, sweep_expired_holds
+)
+from inventory import (  # noqa: E402
+    BRANCHES_COLLECTION, DEFAULT_BRANCH_ID, INVENTORY_COLLECTION, InsufficientStock, available, branch_low_stock,
+    ensure_default_branch, inventory_doc, inventory_report_pipeline, refresh_product_totals, return_stock,
+    seed_branch_stock, take_stock
+)
+from outbox import EVENTS_COLLECTION, Outbox, OutboxDispatcher  # noqa: E402
+from scheduler import RUNS_COLLECTION, RUNS_RETENTION_SECONDS, Scheduler  # noqa: E402
+from rendering import MEDIA_TYPES, RenderCache, invoice_content, payment_payload, render_invoice, render_qr  # noqa: E402
+from rate_limit import CHAT, CRITICAL, NORMAL, AdmissionController, Overloaded, RateLimiter  # noqa: E402
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Payment QR and invoice renderer
+render_cache = RenderCache()
+
+# Background jobs, one run per slot across workers
+scheduler = Scheduler(db)
+EXPIRY_ALERT_DAYS = 30
+
+# Short-lived read caches; concurrent viewers share one computation
+DASHBOARD_CACHE_SECONDS = float(os.environ.get("DASHBOARD_CACHE_SECONDS", 3))
+dashboard_cache = SingleFlightCache("dashboard_stats", ttl_seconds=DASHBOARD_CACHE_SECONDS, stale_while_revalidate=True)
+# Marked stale by stock-changing writes; the TTL bounds staleness across workers
+inventory_report_cache = SingleFlightCache("inventory_report", ttl_seconds=300, stale_while_revalidate=True)
+
+# Domain events outbox and its consumers
+outbox = Outbox(client, db)
+outbox_dispatcher = OutboxDispatcher(db, outbox)
+
 # Create the main app without a prefix
 app = FastAPI(title="Tambar Express - Sistema de Gestión Empresarial")
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Traffic control
+admission = AdmissionController()
+whatsapp_limiter = RateLimiter()
+
+# Long-lived or introspection routes that never take a request slot
+UNTHROTTLED_PATHS = {"/api/events/stream", "/api/metrics"}
+CHAT_PATHS = {"/api/whatsapp/process", "/api/whatsapp/send"}
+
 # Enums
 class ProductCategory(str, Enum):
     VINOS = "vinos"
@@ -43,6 +98,16 @@ class OrderStatus(str, Enum):
     ENTREGADO = "entregado"
     CANCELADO = "cancelado"
 
+# Transiciones válidas de estado de pedido
+ORDER_STATUS_TRANSITIONS = {
+    OrderStatus.PENDIENTE: {OrderStatus.CONFIRMADO, OrderStatus.CANCELADO},
+    OrderStatus.CONFIRMADO: {OrderStatus.EN_PREPARACION, OrderStatus.CANCELADO},
+    OrderStatus.EN_PREPARACION: {OrderStatus.EN_ENTREGA, OrderStatus.CANCELADO},
+    OrderStatus.EN_ENTREGA: {OrderStatus.ENTREGADO, OrderStatus.CANCELADO},
+    OrderStatus.ENTREGADO: set(),
+    OrderStatus.CANCELADO: set(),
+}
+
 class PaymentMethod(str, Enum):
     EFECTIVO = "efectivo"
     QR = "qr"
@@ -62,6 +127,8 @@ class Product(BaseModel):
     min_stock: int = 10  # Stock mínimo para alertas
     supplier: Optional[str] = None
     expiry_date: Optional[str] = None  # Fecha de caducidad
+    expiry_at: Optional[datetime] = None  # expiry_date interpretada, para consultas indexadas
+    lead_time_days: Optional[int] = None  # Días de entrega del proveedor
     category: ProductCategory
     image_url: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -75,6 +142,7 @@ class ProductCreate(BaseModel):
     min_stock: int = 10
     supplier: Optional[str] = None
     expiry_date: Optional[str] = None
+    lead_time_days: Optional[int] = None
     category: ProductCategory
     image_url: Optional[str] = None
 
@@ -82,6 +150,7 @@ class Customer(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
     phone: str
+    phone_e164: Optional[str] = None  # Teléfono normalizado (+591XXXXXXXX)
     email: Optional[str] = None
     address: Optional[str] = None
     total_purchases: float = 0.0
@@ -118,15 +187,77 @@ class Order(BaseModel):
     delivery_fee: float = 0.0
     notes: Optional[str] = None
     qr_code: Optional[str] = None  # QR para pago
+    branch_id: str = DEFAULT_BRANCH_ID  # Sucursal que despacha el pedido
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     delivered_at: Optional[datetime] = None
 
 class OrderCreate(BaseModel):
     customer_id: str
-    items: List[dict]  # {"product_id": str, "quantity": int}
+    items: List[dict] = []  # {"product_id": str, "quantity": int}
+    cart_id: Optional[str] = None  # Pedido a partir de las reservas del carrito, en lugar de items
     delivery_address: Optional[str] = None
     payment_method: Optional[PaymentMethod] = None
     notes: Optional[str] = None
+    branch_id: str = DEFAULT_BRANCH_ID
+
+class OrderPage(BaseModel):
+    orders: List[Order]
+    next_cursor: Optional[str] = None  # Pasar como ?cursor= para la siguiente página
+
+class OrderStatusUpdate(BaseModel):
+    order_id: str
+    status: OrderStatus
+
+class BulkOrderStatusUpdate(BaseModel):
+    updates: List[OrderStatusUpdate]
+
+class OrderStatusResult(BaseModel):
+    order_id: str
+    result: str  # updated, unchanged, invalid_transition, not_found, conflict
+    status: Optional[OrderStatus] = None
+    detail: Optional[str] = None
+
+class Branch(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    address: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class BranchCreate(BaseModel):
+    name: str
+    address: Optional[str] = None
+
+class BranchStock(BaseModel):
+    branch_id: str
+    product_id: str
+    stock: int
+    held: int = 0  # Reservado en carritos
+    available: int = 0  # stock - held
+    min_stock: int
+    updated_at: datetime
+
+class BranchStockUpdate(BaseModel):
+    stock: Optional[int] = None
+    min_stock: Optional[int] = None
+
+class StockHold(BaseModel):
+    id: str
+    cart_id: str
+    branch_id: str
+    product_id: str
+    quantity: int
+    expires_at: datetime
+    created_at: datetime
+
+class HoldRequest(BaseModel):
+    product_id: str
+    quantity: int  # Cantidad total reservada; 0 libera la reserva
+    branch_id: str = DEFAULT_BRANCH_ID
+    ttl_seconds: Optional[int] = None
+
+class Cart(BaseModel):
+    cart_id: str
+    holds: List[StockHold]
 
 class WhatsAppMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -147,6 +278,18 @@ class SocialMediaPost(BaseModel):
     engagement: dict = {}  # likes, shares, comments
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class ReorderSuggestion(BaseModel):
+    product_id: str
+    product_name: str
+    stock: int
+    current_min_stock: int
+    lead_time_days: int
+    forecast_daily_demand: float  # Demanda diaria pronosticada
+    demand_std: float
+    suggested_min_stock: int  # Punto de reorden sugerido
+    suggested_reorder_qty: int  # Cantidad a pedir al proveedor
+    updated_at: datetime
+
 class DashboardStats(BaseModel):
     total_products: int
     low_stock_alerts: int
@@ -156,15 +299,218 @@ class DashboardStats(BaseModel):
     monthly_sales: float
     total_customers: int
     whatsapp_messages: int
+    branch_id: Optional[str] = None  # None: todas las sucursales
+
+class InventoryReportLine(BaseModel):
+    category: Optional[str] = None  # None en la línea de totales
+    products: int
+    units: int
+    cost_value: float  # Stock valorizado a precio de costo
+    sale_value: float  # Stock valorizado a precio de venta
+    potential_margin: float
+    margin_percent: float
+    low_stock: int
+    expiring: int
+
+class InventoryReport(BaseModel):
+    branch_id: Optional[str] = None  # None: todas las sucursales
+    expiring_days: int
+    totals: InventoryReportLine
+    categories: List[InventoryReportLine]
+    generated_at: datetime
 
 # Helper functions
-def calculate_taxes(subtotal: float):
-    iva = subtotal * 0.13  # 13% IVA
-    it = subtotal * 0.03   # 3% IT
-    return iva, it
+EXPIRY_DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d", "%d/%m/%y", "%m/%Y", "%Y-%m")
+
+def parse_expiry_date(value: Optional[str]):
+    """Parse the free-form expiry_date; month-only dates expire at the start of that month."""
+    if not value:
+        return None
+    value = value.strip()
+    for fmt in EXPIRY_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+def looks_like_phone(query: str):
+    return bool(re.fullmatch(r"[\d\s+()-]{7,}", query.strip()))
+
+MAX_BATCH_IDS = 500
+
+def parse_ids(ids: Optional[str]):
+    """Split ``?ids=a,b,c`` into a de-duplicated list, keeping request order."""
+    if ids is None:
+        return None
+    parsed = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if len(parsed) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per request")
+    return parsed
+
+def order_by_ids(docs: List[dict], ids: List[str]):
+    by_id = {doc["id"]: doc for doc in docs}
+    return [by_id[i] for i in ids if i in by_id]
+
+def field_projection(model, fields: Optional[str]):
+    """Turn ``?fields=a,b`` into a Mongo projection (top-level fields only)."""
+    if not fields:
+        return None, None
+    selected = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in selected if f not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    if "id" in model.model_fields and "id" not in selected:
+        selected = ("id",) + selected
+    return {"_id": 0, **{f: 1 for f in selected}}, selected
+
+@lru_cache(maxsize=256)
+def partial_model(model, selected: Tuple[str, ...]):
+    return create_model(
+        f"Partial{model.__name__}",
+        **{f: (Optional[model.model_fields[f].annotation], None) for f in selected}
+    )
+
+def resource_response(model, docs: List[dict], selected: Optional[Tuple[str, ...]]):
+    if selected is None:
+        return [model(**doc) for doc in docs]
+    partial = partial_model(model, selected)
+    return JSONResponse(jsonable_encoder([partial(**doc) for doc in docs]))
+
+def allowed_previous_statuses(status: OrderStatus):
+    return [previous.value for previous, targets in ORDER_STATUS_TRANSITIONS.items() if status in targets]
 
-def calculate_margin(cost_price: float, sale_price: float):
-    return ((sale_price - cost_price) / cost_price * 100) if cost_price > 0 else 0
+def status_update_fields(status: OrderStatus):
+    update_data = {"status": status.value}
+    if status == OrderStatus.ENTREGADO:
+        update_data["delivered_at"] = datetime.now(timezone.utc)
+    return update_data
+
+def publish_counters(**deltas):
+    """Push dashboard counter deltas to live clients."""
+    event_bus.publish("dashboard", "counters", deltas)
+
+def publish_stock_delta(product_id: str, delta: int, branch_id: str = DEFAULT_BRANCH_ID):
+    event_bus.publish("stock", "stock.changed", {"product_id": product_id, "branch_id": branch_id, "delta": delta})
+
+def publish_status_change(order: dict, previous_status: str, status: OrderStatus):
+    event_bus.publish("orders", "order.status", {"id": order["id"], "status": status.value})
+    deltas = {}
+    if previous_status == OrderStatus.PENDIENTE.value:
+        deltas["pending_orders"] = -1
+    if status == OrderStatus.CANCELADO and order.get("created_at"):
+        now = datetime.now(timezone.utc)
+        created_at = order["created_at"].replace(tzinfo=timezone.utc)
+        if (created_at.year, created_at.month) == (now.year, now.month):
+            deltas["monthly_sales"] = -order["total"]
+            if created_at.date() == now.date():
+                deltas["today_sales"] = -order["total"]
+    if deltas:
+        publish_counters(**deltas)
+
+def publish_whatsapp_message(msg: WhatsAppMessage):
+    event_bus.publish("whatsapp", "message.created", msg.dict())
+    publish_counters(whatsapp_messages=1)
+
+async def restore_stock(orders: List[dict], session=None):
+    """Return the items of cancelled orders to their branch inventory in one bulk write."""
+    quantities = {}
+    for order in orders:
+        branch_id = order.get("branch_id", DEFAULT_BRANCH_ID)
+        for item in order.get("items", []):
+            key = (branch_id, item["product_id"])
+            quantities[key] = quantities.get(key, 0) + item["quantity"]
+    if quantities:
+        await return_stock(db, quantities, session=session)
+        for (branch_id, product_id), qty in quantities.items():
+            publish_stock_delta(product_id, qty, branch_id)
+        inventory_report_cache.mark_stale()
+
+async def find_customer_by_phone(phone: str):
+    return await db.customers.find_one({"phone_e164": normalize_phone(phone)})
+
+def status_event(order: dict, previous_status: str, status: OrderStatus):
+    return ("order.status_changed", order["id"], {
+        "customer_id": order.get("customer_id"),
+        "previous_status": previous_status,
+        "status": status.value
+    })
+
+PREFERRED_PRODUCTS_TOP_K = 5
+
+async def claim_order_effect(order_id: str, flag: str):
+    """Flag an order so a redelivered event does not apply its side effect twice."""
+    claimed = await db.orders.update_one({"id": order_id, flag: {"$ne": True}}, {"$set": {flag: True}})
+    return claimed.modified_count == 1
+
+async def count_preferred_products(customer_id: str, items: List[dict], sign: int):
+    """Adjust per-customer product counts and refresh the top-K preferred_products."""
+    quantities = {}
+    names = {}
+    for item in items:
+        quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+        names[item["product_id"]] = item["product_name"]
+    if not quantities:
+        return
+    await db.customer_product_counts.bulk_write([
+        UpdateOne(
+            {"customer_id": customer_id, "product_id": product_id},
+            {"$inc": {"quantity": sign * qty}, "$set": {"product_name": names[product_id]}},
+            upsert=True
+        )
+        for product_id, qty in quantities.items()
+    ], ordered=False)
+    top = await db.customer_product_counts.find(
+        {"customer_id": customer_id, "quantity": {"$gt": 0}}, {"_id": 0, "product_name": 1}
+    ).sort("quantity", -1).limit(PREFERRED_PRODUCTS_TOP_K).to_list(PREFERRED_PRODUCTS_TOP_K)
+    await db.customers.update_one(
+        {"id": customer_id},
+        {"$set": {"preferred_products": [entry["product_name"] for entry in top]}}
+    )
+
+# Outbox consumers
+@outbox_dispatcher.consumer("preferred_products", event_types=["order.created", "order.status_changed"])
+async def track_preferred_products(event):
+    payload = event["payload"]
+    if event["type"] == "order.created":
+        if await claim_order_effect(payload["id"], "preferences_applied"):
+            await count_preferred_products(payload["customer_id"], payload["items"], 1)
+    elif payload["status"] == OrderStatus.CANCELADO.value:
+        order = await db.orders.find_one(
+            {"id": event["aggregate_id"], "preferences_applied": True}, {"_id": 0, "customer_id": 1, "items": 1}
+        )
+        if order and await claim_order_effect(event["aggregate_id"], "preferences_reverted"):
+            await count_preferred_products(order["customer_id"], order["items"], -1)
+
+@outbox_dispatcher.consumer("stock_totals", event_types=["order.created", "order.status_changed", "inventory.adjusted"])
+async def refresh_stock_totals(event):
+    # Recomputing from inventory makes redelivery harmless
+    payload = event["payload"]
+    if event["type"] == "order.created":
+        product_ids = [item["product_id"] for item in payload["items"]]
+    elif event["type"] == "inventory.adjusted":
+        product_ids = [payload["product_id"]]
+    elif payload["status"] == OrderStatus.CANCELADO.value:
+        order = await db.orders.find_one({"id": event["aggregate_id"]}, {"_id": 0, "items": 1})
+        product_ids = [item["product_id"] for item in order["items"]] if order else []
+    else:
+        return
+    await refresh_product_totals(db, product_ids)
+    inventory_report_cache.mark_stale()
+
+@outbox_dispatcher.consumer("loyalty", event_types=["order.created"])
+async def apply_loyalty_points(event):
+    order = event["payload"]
+    if await claim_order_effect(order["id"], "loyalty_applied"):
+        # Update customer loyalty points (1 point per 10 Bs)
+        points = int(order["total"] / 10)
+        await db.customers.update_one(
+            {"id": order["customer_id"]},
+            {"$inc": {"total_purchases": order["total"], "loyalty_points": points}}
+        )
 
 # API Routes
 
@@ -174,13 +520,27 @@ async def root():
 
 # Dashboard
 @api_router.get("/dashboard/stats", response_model=DashboardStats)
-async def get_dashboard_stats():
-    total_products = await db.products.count_documents({})
-    low_stock_alerts = await db.products.count_documents({"$expr": {"$lt": ["$stock", "$min_stock"]}})
-    total_orders = await db.orders.count_documents({})
-    pending_orders = await db.orders.count_documents({"status": "pendiente"})
-    total_customers = await db.customers.count_documents({})
-    whatsapp_messages = await db.whatsapp_messages.count_documents({})
+@dashboard_cache.cached
+async def get_dashboard_stats(branch_id: Optional[str] = None):
+    if branch_id:
+        branch_filter = {"branch_id": branch_id}
+        total_products = await db[INVENTORY_COLLECTION].count_documents(branch_filter)
+        low_stock_alerts = await db[INVENTORY_COLLECTION].count_documents(
+            {**branch_filter, "$expr": {"$lt": ["$stock", "$min_stock"]}}
+        )
+        # Archived orders are only counted globally
+        total_orders = await db.orders.count_documents(branch_filter)
+    else:
+        # Whole-collection totals come from metadata plus the archived counters
+        branch_filter = {}
+        total_products = await db.products.estimated_document_count()
+        low_stock_alerts = await db.products.count_documents({"$expr": {"$lt": ["$stock", "$min_stock"]}})
+        total_orders = await db.orders.estimated_document_count() + await archived_count(db, "orders")
+    pending_orders = await db.orders.count_documents({**branch_filter, "status": "pendiente"})
+    total_customers = await db.customers.estimated_document_count()
+    whatsapp_messages = (
+        await db.whatsapp_messages.estimated_document_count() + await archived_count(db, "whatsapp_messages")
+    )
     
     # Today's sales
     today = datetime.now(timezone.utc).date()
@@ -188,6 +548,7 @@ async def get_dashboard_stats():
     today_end = datetime.combine(today, datetime.max.time()).replace(tzinfo=timezone.utc)
     
     today_orders = await db.orders.find({
+        **branch_filter,
         "created_at": {"$gte": today_start, "$lte": today_end},
         "status": {"$ne": "cancelado"}
     }).to_list(1000)
@@ -195,6 +556,7 @@ async def get_dashboard_stats():
     
     # Monthly sales (current month)
     monthly_orders = await db.orders.find({
+        **branch_filter,
         "created_at": {"$gte": datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)},
         "status": {"$ne": "cancelado"}
     }).to_list(1000)
@@ -208,55 +570,374 @@ async def get_dashboard_stats():
         today_sales=today_sales,
         monthly_sales=monthly_sales,
         total_customers=total_customers,
-        whatsapp_messages=whatsapp_messages
+        whatsapp_messages=whatsapp_messages,
+        branch_id=branch_id
     )
 
 # Products
 @api_router.get("/products", response_model=List[Product])
-async def get_products():
-    products = await db.products.find().to_list(1000)
-    return [Product(**product) for product in products]
+async def get_products(ids: Optional[str] = None, fields: Optional[str] = None):
+    projection, selected = field_projection(Product, fields)
+    product_ids = parse_ids(ids)
+    if product_ids is not None:
+        products = order_by_ids(
+            await db.products.find({"id": {"$in": product_ids}}, projection).to_list(len(product_ids)), product_ids
+        )
+    else:
+        products = await db.products.find({}, projection).to_list(1000)
+    return resource_response(Product, products, selected)
 
 @api_router.post("/products", response_model=Product)
-async def create_product(product: ProductCreate):
+async def create_product(product: ProductCreate, branch_id: str = DEFAULT_BRANCH_ID):
     product_dict = product.dict()
     product_dict["margin"] = calculate_margin(product.cost_price, product.sale_price)
+    product_dict["expiry_at"] = parse_expiry_date(product.expiry_date)
     product_obj = Product(**product_dict)
-    await db.products.insert_one(product_obj.dict())
+    # Initial stock is received at one branch
+    async with outbox.unit() as session:
+        await db.products.insert_one(product_obj.dict(), session=session)
+        await db[INVENTORY_COLLECTION].insert_one(inventory_doc(branch_id, product_obj.dict()), session=session)
+        await outbox.record("product.created", product_obj.id, product_obj.dict(), session=session)
+    inventory_report_cache.mark_stale()
+    event_bus.publish("stock", "product.created", {
+        "product_id": product_obj.id, "branch_id": branch_id, "stock": product_obj.stock
+    })
+    publish_counters(total_products=1)
     return product_obj
 
 @api_router.put("/products/{product_id}", response_model=Product)
-async def update_product(product_id: str, product: ProductCreate):
+async def update_product(product_id: str, product: ProductCreate, branch_id: Optional[str] = None):
     product_dict = product.dict()
     product_dict["margin"] = calculate_margin(product.cost_price, product.sale_price)
-    await db.products.update_one({"id": product_id}, {"$set": product_dict})
-    updated_product = await db.products.find_one({"id": product_id})
+    product_dict["expiry_at"] = parse_expiry_date(product.expiry_date)
+    # Product.stock is the total across branches; stock is only written to the branch named in ?branch_id=
+    stock = product_dict.pop("stock")
+    async with outbox.unit() as session:
+        updated_product = await db.products.find_one_and_update(
+            {"id": product_id},
+            {"$set": product_dict},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if updated_product:
+            await outbox.record("product.updated", product_id, product_dict, session=session)
     if not updated_product:
         raise HTTPException(status_code=404, detail="Product not found")
+    if branch_id:
+        await write_branch_stock(branch_id, updated_product, {"stock": stock})
+        await refresh_product_totals(db, [product_id])
+        updated_product = await db.products.find_one({"id": product_id})
+    inventory_report_cache.mark_stale()
     return Product(**updated_product)
 
-@api_router.get("/products/low-stock")
-async def get_low_stock_products():
-    products = await db.products.find({"$expr": {"$lt": ["$stock", "$min_stock"]}}).to_list(1000)
+async def find_expiring_products(days: int):
+    horizon = datetime.now(timezone.utc) + timedelta(days=days)
+    return await db.products.find(
+        {"expiry_at": {"$ne": None, "$lte": horizon}, "stock": {"$gt": 0}}
+    ).sort("expiry_at", 1).to_list(1000)
+
+@api_router.get("/products/expiring", response_model=List[Product])
+async def get_expiring_products(days: int = EXPIRY_ALERT_DAYS):
+    products = await find_expiring_products(days)
     return [Product(**product) for product in products]
 
+@api_router.get("/products/low-stock")
+async def get_low_stock_products(branch_id: Optional[str] = None, fields: Optional[str] = None):
+    projection, selected = field_projection(Product, fields)
+    if not branch_id:
+        # Across branches: total stock against the product minimum
+        products = await db.products.find({"$expr": {"$lt": ["$stock", "$min_stock"]}}, projection).to_list(1000)
+        return resource_response(Product, products, selected)
+    levels = {entry["product_id"]: entry for entry in await branch_low_stock(db, branch_id)}
+    products = await db.products.find({"id": {"$in": list(levels)}}, projection).to_list(len(levels))
+    for product in products:
+        # Report the branch's own stock and minimum
+        product.update(stock=levels[product["id"]]["stock"], min_stock=levels[product["id"]]["min_stock"])
+    return resource_response(Product, products, selected)
+
+# Branches and per-branch inventory
+@api_router.get("/branches", response_model=List[Branch])
+async def get_branches():
+    branches = await db[BRANCHES_COLLECTION].find().sort("created_at", 1).to_list(1000)
+    return [Branch(**branch) for branch in branches]
+
+@api_router.post("/branches", response_model=Branch)
+async def create_branch(branch: BranchCreate):
+    branch_obj = Branch(**branch.dict())
+    await db[BRANCHES_COLLECTION].insert_one(branch_obj.dict())
+    return branch_obj
+
+@api_router.get("/inventory", response_model=List[BranchStock])
+async def get_inventory(branch_id: Optional[str] = None, product_id: Optional[str] = None):
+    if not branch_id and not product_id:
+        raise HTTPException(status_code=400, detail="Filter by branch_id or product_id")
+    query = {}
+    if branch_id:
+        query["branch_id"] = branch_id
+    if product_id:
+        query["product_id"] = product_id
+    entries = await db[INVENTORY_COLLECTION].find(query).to_list(5000)
+    return [BranchStock(**entry, available=available(entry)) for entry in entries]
+
+@api_router.put("/inventory/{branch_id}/{product_id}", response_model=BranchStock)
+async def set_branch_stock(branch_id: str, product_id: str, update: BranchStockUpdate):
+    changes = {field: value for field, value in update.dict().items() if value is not None}
+    if not changes:
+        raise HTTPException(status_code=400, detail="Nothing to update")
+    product = await db.products.find_one({"id": product_id}, {"_id": 0, "id": 1, "min_stock": 1})
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    entry = await write_branch_stock(branch_id, product, changes)
+    return BranchStock(**entry, available=available(entry))
+
+async def write_branch_stock(branch_id: str, product: dict, changes: dict):
+    """Set stock and/or min_stock of one branch inventory document."""
+    if await db[BRANCHES_COLLECTION].count_documents({"id": branch_id}, limit=1) == 0:
+        raise HTTPException(status_code=404, detail="Branch not found")
+    product_id = product["id"]
+    query = {"branch_id": branch_id, "product_id": product_id}
+    if "stock" in changes:
+        # Units held in carts cannot be counted away; a blocked upsert fails on the unique index
+        query["held"] = {"$not": {"$gt": changes["stock"]}}
+    # A branch receiving a product for the first time starts from zero
+    defaults = {k: v for k, v in {"stock": 0, "min_stock": product.get("min_stock", 10)}.items() if k not in changes}
+    operations = {"$set": {**changes, "updated_at": datetime.now(timezone.utc)}}
+    if defaults:
+        operations["$setOnInsert"] = defaults
+    try:
+        async with outbox.unit() as session:
+            entry = await db[INVENTORY_COLLECTION].find_one_and_update(
+                query,
+                operations,
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            await outbox.record("inventory.adjusted", product_id, {
+                "branch_id": branch_id, "product_id": product_id, **changes
+            }, session=session)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Stock cannot be lower than the units held in carts")
+    inventory_report_cache.mark_stale()
+    event_bus.publish("stock", "stock.changed", {"product_id": product_id, "branch_id": branch_id, "stock": entry["stock"]})
+    return entry
+
+# Carts: expiring stock holds converted to order lines at checkout
+def whatsapp_cart_id(phone: str):
+    return f"whatsapp:{normalize_phone(phone)}"
+
+async def hold_stock(cart_id: str, request: HoldRequest):
+    try:
+        return await place_hold(
+            db, cart_id, request.branch_id, request.product_id, request.quantity, request.ttl_seconds
+        )
+    except InsufficientStock:
+        raise HTTPException(status_code=400, detail="Insufficient stock available to hold")
+    except HoldConflict as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+
+@api_router.get("/carts/{cart_id}", response_model=Cart)
+async def get_cart(cart_id: str):
+    return Cart(cart_id=cart_id, holds=[StockHold(**hold) for hold in await cart_holds(db, cart_id)])
+
+@api_router.put("/carts/{cart_id}/holds", response_model=Cart)
+async def set_cart_hold(cart_id: str, request: HoldRequest):
+    if await db.products.count_documents({"id": request.product_id}, limit=1) == 0:
+        raise HTTPException(status_code=404, detail="Product not found")
+    await hold_stock(cart_id, request)
+    return await get_cart(cart_id)
+
+@api_router.delete("/carts/{cart_id}/holds/{product_id}", response_model=Cart)
+async def delete_cart_hold(cart_id: str, product_id: str):
+    await release_hold(db, cart_id, product_id)
+    return await get_cart(cart_id)
+
+@api_router.post("/carts/{cart_id}/extend", response_model=Cart)
+async def extend_cart_holds(cart_id: str, ttl_seconds: Optional[int] = None):
+    if not await extend_cart(db, cart_id, ttl_seconds):
+        raise HTTPException(status_code=404, detail="Cart is empty or its holds expired")
+    return await get_cart(cart_id)
+
+# Inventory forecasting
+@api_router.post("/inventory/forecast/refresh")
+async def refresh_forecast(full: bool = False):
+    result = await refresh_reorder_suggestions(db, full=full)
+    return {"status": "success", **result}
+
+@api_router.get("/inventory/reorder-suggestions", response_model=List[ReorderSuggestion])
+async def get_reorder_suggestions(only_changes: bool = False):
+    query = {}
+    if only_changes:
+        query = {"$expr": {"$ne": ["$suggested_min_stock", "$current_min_stock"]}}
+    suggestions = await db[SUGGESTIONS_COLLECTION].find(query).sort("suggested_reorder_qty", -1).to_list(1000)
+    return [ReorderSuggestion(**suggestion) for suggestion in suggestions]
+
+@api_router.post("/inventory/reorder-suggestions/{product_id}/apply", response_model=Product)
+async def apply_reorder_suggestion(product_id: str):
+    suggestion = await db[SUGGESTIONS_COLLECTION].find_one({"product_id": product_id})
+    if not suggestion:
+        raise HTTPException(status_code=404, detail="Suggestion not found")
+    await db.products.update_one({"id": product_id}, {"$set": {"min_stock": suggestion["suggested_min_stock"]}})
+    updated_product = await db.products.find_one({"id": product_id})
+    if not updated_product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    await db[SUGGESTIONS_COLLECTION].update_one(
+        {"product_id": product_id},
+        {"$set": {"current_min_stock": suggestion["suggested_min_stock"]}}
+    )
+    inventory_report_cache.mark_stale()
+    return Product(**updated_product)
+
+# Reports
+def inventory_report_line(group: dict, category: Optional[str] = None):
+    return InventoryReportLine(
+        category=category,
+        products=group["products"],
+        units=group["units"],
+        cost_value=round(group["cost_value"], 2),
+        sale_value=round(group["sale_value"], 2),
+        potential_margin=round(group["sale_value"] - group["cost_value"], 2),
+        margin_percent=round(calculate_margin(group["cost_value"], group["sale_value"]), 2),
+        low_stock=group["low_stock"],
+        expiring=group["expiring"]
+    )
+
+@api_router.get("/reports/inventory", response_model=InventoryReport)
+@inventory_report_cache.cached
+async def get_inventory_report(branch_id: Optional[str] = None):
+    horizon = datetime.now(timezone.utc) + timedelta(days=EXPIRY_ALERT_DAYS)
+    collection = db[INVENTORY_COLLECTION] if branch_id else db.products
+    groups = await collection.aggregate(inventory_report_pipeline(horizon, branch_id)).to_list(None)
+    fields = ("products", "units", "cost_value", "sale_value", "low_stock", "expiring")
+    totals = {field: sum(group[field] for group in groups) for field in fields}
+    return InventoryReport(
+        branch_id=branch_id,
+        expiring_days=EXPIRY_ALERT_DAYS,
+        totals=inventory_report_line(totals),
+        categories=[inventory_report_line(group, group["_id"]) for group in groups],
+        generated_at=datetime.now(timezone.utc)
+    )
+
 # Customers
 @api_router.get("/customers", response_model=List[Customer])
-async def get_customers():
-    customers = await db.customers.find().to_list(1000)
-    return [Customer(**customer) for customer in customers]
+async def get_customers(ids: Optional[str] = None, fields: Optional[str] = None):
+    projection, selected = field_projection(Customer, fields)
+    customer_ids = parse_ids(ids)
+    if customer_ids is not None:
+        customers = order_by_ids(
+            await db.customers.find({"id": {"$in": customer_ids}}, projection).to_list(len(customer_ids)),
+            customer_ids
+        )
+    else:
+        customers = await db.customers.find({}, projection).to_list(1000)
+    return resource_response(Customer, customers, selected)
+
+@api_router.get("/customers/search", response_model=List[Customer])
+async def search_customers(q: str, limit: int = 20, fields: Optional[str] = None):
+    projection, selected = field_projection(Customer, fields)
+    q = q.strip()
+    if not q:
+        return []
+    limit = max(1, min(limit, 100))
+    if looks_like_phone(q):
+        query = {"phone_e164": normalize_phone(q)}
+    else:
+        query = {"name_lower": {"$regex": f"^{re.escape(q.lower())}"}}
+    customers = await db.customers.find(query, projection).sort("name_lower", 1).limit(limit).to_list(limit)
+    return resource_response(Customer, customers, selected)
+
+def encode_order_cursor(order: dict):
+    raw = f"{order['created_at'].isoformat()}|{order['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_order_cursor(cursor: str):
+    try:
+        created_at, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), order_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@api_router.get("/customers/{customer_id}/orders", response_model=OrderPage)
+async def get_customer_orders(
+    customer_id: str, limit: int = 20, cursor: Optional[str] = None, archived: bool = False
+):
+    limit = max(1, min(limit, 100))
+    query = {"customer_id": customer_id}
+    if cursor:
+        # Keyset pagination over the (customer_id, created_at, id) index
+        created_at, order_id = decode_order_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": order_id}}
+        ]
+    orders = await db.orders.find(query).sort([("created_at", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    if archived and len(orders) <= limit and await archived_before(db, "orders"):
+        # Opt-in: in file mode finding a customer's archived orders reads every partition
+        orders += await archived_customer_orders(customer_id, cursor, {order["id"] for order in orders})
+        orders = orders[:limit + 1]
+    next_cursor = encode_order_cursor(orders[limit - 1]) if len(orders) > limit else None
+    return OrderPage(orders=[Order(**order) for order in orders[:limit]], next_cursor=next_cursor)
+
+async def archived_customer_orders(customer_id: str, cursor: Optional[str], seen: set):
+    def order_key(order):
+        # Hot documents come back naive and archived ones aware, both in UTC
+        return (order["created_at"].replace(tzinfo=None), order["id"])
+    before = None
+    if cursor:
+        created_at, order_id = decode_order_cursor(cursor)
+        before = (created_at.replace(tzinfo=None), order_id)
+    orders = await find_archived(db, "orders", {"customer_id": customer_id})
+    orders = [order for order in orders if order["id"] not in seen and (before is None or order_key(order) < before)]
+    return sorted(orders, key=order_key, reverse=True)
+
+async def find_order(order_id: str, projection: Optional[dict] = None):
+    """An order by id, looked up in the archive when it is no longer in ``orders``."""
+    order = await db.orders.find_one({"id": order_id}, projection)
+    if not order and await archived_before(db, "orders"):
+        archived = await find_archived(db, "orders", {"id": order_id}, limit=1)
+        order = archived[0] if archived else None
+    return order
+
+@api_router.post("/customers/{customer_id}/orders/repeat", response_model=Order)
+async def repeat_last_order(customer_id: str):
+    last_order = await db.orders.find_one(
+        {"customer_id": customer_id, "status": {"$ne": OrderStatus.CANCELADO.value}},
+        sort=[("created_at", -1), ("id", -1)]
+    )
+    if not last_order:
+        raise HTTPException(status_code=404, detail="No previous order to repeat")
+    return await create_order(OrderCreate(
+        customer_id=customer_id,
+        items=[{"product_id": item["product_id"], "quantity": item["quantity"]} for item in last_order["items"]],
+        delivery_address=last_order.get("delivery_address"),
+        payment_method=last_order.get("payment_method"),
+        notes=last_order.get("notes"),
+        branch_id=last_order.get("branch_id", DEFAULT_BRANCH_ID)
+    ))
 
 @api_router.post("/customers", response_model=Customer)
 async def create_customer(customer: CustomerCreate):
-    customer_obj = Customer(**customer.dict())
-    await db.customers.insert_one(customer_obj.dict())
+    customer_obj = Customer(**customer.dict(), phone_e164=normalize_phone(customer.phone))
+    customer_dict = customer_obj.dict()
+    customer_dict.update(customer_search_fields(customer_dict))
+    await db.customers.insert_one(customer_dict)
+    publish_counters(total_customers=1)
     return customer_obj
 
 # Orders
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders():
-    orders = await db.orders.find().sort("created_at", -1).to_list(1000)
-    return [Order(**order) for order in orders]
+async def get_orders(since: Optional[datetime] = None, ids: Optional[str] = None, fields: Optional[str] = None):
+    projection, selected = field_projection(Order, fields)
+    order_ids = parse_ids(ids)
+    if order_ids is not None:
+        orders = order_by_ids(
+            await db.orders.find({"id": {"$in": order_ids}}, projection).to_list(len(order_ids)), order_ids
+        )
+    elif since:
+        orders = await find_with_archive(db, "orders", {}, since, 1000, projection=projection)
+    else:
+        orders = await db.orders.find({}, projection).sort("created_at", -1).to_list(1000)
+    return resource_response(Order, orders, selected)
 
 @api_router.post("/orders", response_model=Order)
 async def create_order(order: OrderCreate):
@@ -265,18 +946,40 @@ async def create_order(order: OrderCreate):
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
     
+    # Checkout from a cart turns its holds into the order lines
+    holds = None
+    if order.cart_id:
+        if order.items:
+            raise HTTPException(status_code=400, detail="Send either items or cart_id, not both")
+        holds = await cart_holds(db, order.cart_id)
+        if not holds:
+            raise HTTPException(status_code=400, detail="Cart is empty or its holds expired")
+        items = [{"product_id": hold["product_id"], "quantity": hold["quantity"]} for hold in holds]
+        branch_id = holds[0]["branch_id"]
+    else:
+        items = order.items
+        branch_id = order.branch_id
+        if not items:
+            raise HTTPException(status_code=400, detail="Order has no items")
+    
     # Calculate order totals
+    quantities = {}
+    for item in items:
+        quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    products = {
+        product["id"]: product
+        async for product in db.products.find(
+            {"id": {"$in": list(quantities)}}, {"_id": 0, "id": 1, "name": 1, "sale_price": 1}
+        )
+    }
     order_items = []
     subtotal = 0
     
-    for item in order.items:
-        product = await db.products.find_one({"id": item["product_id"]})
+    for item in items:
+        product = products.get(item["product_id"])
         if not product:
             raise HTTPException(status_code=404, detail=f"Product {item['product_id']} not found")
         
-        if product["stock"] < item["quantity"]:
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
-        
         item_total = product["sale_price"] * item["quantity"]
         order_items.append(OrderItem(
             product_id=item["product_id"],
@@ -286,19 +989,19 @@ async def create_order(order: OrderCreate):
             total_price=item_total
         ))
         subtotal += item_total
-        
-        # Update stock
-        await db.products.update_one(
-            {"id": item["product_id"]}, 
-            {"$inc": {"stock": -item["quantity"]}}
-        )
+    
+    # Update stock at the branch that dispatches the order
+    try:
+        if holds:
+            await convert_holds(db, holds)
+        else:
+            await take_stock(db, branch_id, quantities)
+    except InsufficientStock as exc:
+        raise HTTPException(status_code=400, detail=f"Insufficient stock for {products[exc.product_id]['name']}")
     
     iva, it = calculate_taxes(subtotal)
     total = subtotal + iva + it + order.delivery_fee if hasattr(order, 'delivery_fee') else subtotal + iva + it
     
-    # Generate QR code for payment (simulated)
-    qr_code = f"qr_payment_{uuid.uuid4().hex[:8]}_{int(total)}"
-    
     order_obj = Order(
         customer_id=order.customer_id,
         customer_name=customer["name"],
@@ -311,37 +1014,189 @@ async def create_order(order: OrderCreate):
         delivery_address=order.delivery_address,
         payment_method=order.payment_method,
         notes=order.notes,
-        qr_code=qr_code
+        branch_id=branch_id
     )
+    # Payment reference encoded in the QR served by /orders/{id}/qr
+    order_obj.qr_code = payment_payload({"id": order_obj.id, "total": order_obj.total})
     
-    await db.orders.insert_one(order_obj.dict())
+    # Loyalty points are awarded by the outbox consumer, off the request path
+    try:
+        async with outbox.unit() as session:
+            await db.orders.insert_one(order_obj.dict(), session=session)
+            await outbox.record("order.created", order_obj.id, order_obj.dict(), session=session)
+    except Exception:
+        # Without transactions the order may already be stored; remove it before returning its stock
+        await db.orders.delete_one({"id": order_obj.id})
+        await return_stock(db, {(branch_id, product_id): qty for product_id, qty in quantities.items()})
+        raise
     
-    # Update customer loyalty points (1 point per 10 Bs)
-    points = int(total / 10)
-    await db.customers.update_one(
-        {"id": order.customer_id},
-        {"$inc": {"total_purchases": total, "loyalty_points": points}}
-    )
+    event_bus.publish("orders", "order.created", {
+        "id": order_obj.id,
+        "customer_name": order_obj.customer_name,
+        "total": order_obj.total,
+        "status": order_obj.status.value,
+        "created_at": order_obj.created_at
+    })
+    for product_id, qty in quantities.items():
+        publish_stock_delta(product_id, -qty, branch_id)
+    inventory_report_cache.mark_stale()
+    publish_counters(total_orders=1, pending_orders=1, today_sales=total, monthly_sales=total)
     
     return order_obj
 
 @api_router.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: OrderStatus):
-    update_data = {"status": status.value}
-    if status == OrderStatus.ENTREGADO:
-        update_data["delivered_at"] = datetime.now(timezone.utc)
-    
-    await db.orders.update_one({"id": order_id}, {"$set": update_data})
-    updated_order = await db.orders.find_one({"id": order_id})
+    # The status filter makes the transition atomic: a concurrent update loses the race
+    # Pipeline update so the returned document also records the status it left
+    async with outbox.unit() as session:
+        updated_order = await db.orders.find_one_and_update(
+            {"id": order_id, "status": {"$in": allowed_previous_statuses(status)}},
+            [{"$set": {"previous_status": "$status", **status_update_fields(status)}}],
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if updated_order:
+            await outbox.record(*status_event(updated_order, updated_order["previous_status"], status), session=session)
+            if status == OrderStatus.CANCELADO:
+                await restore_stock([updated_order], session=session)
     if not updated_order:
-        raise HTTPException(status_code=404, detail="Order not found")
+        current = await db.orders.find_one({"id": order_id}, {"status": 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if current["status"] == status.value:
+            raise HTTPException(status_code=409, detail=f"Order is already {status.value}")
+        raise HTTPException(
+            status_code=409,
+            detail=f"Invalid status transition from {current['status']} to {status.value}"
+        )
+    publish_status_change(updated_order, updated_order["previous_status"], status)
     return Order(**updated_order)
 
+@api_router.post("/orders/status/bulk", response_model=List[OrderStatusResult])
+async def bulk_update_order_status(payload: BulkOrderStatusUpdate):
+    order_ids = [update.order_id for update in payload.updates]
+    current = {
+        order["id"]: order
+        async for order in db.orders.find(
+            {"id": {"$in": order_ids}},
+            {"_id": 0, "id": 1, "customer_id": 1, "status": 1, "items": 1, "total": 1, "created_at": 1, "branch_id": 1}
+        )
+    }
+
+    # Tag this batch so the re-read below only credits transitions it applied. A set rather than
+    # a single field, so a concurrent batch moving the same order on cannot overwrite the tag
+    batch_token = uuid.uuid4().hex
+    results = [None] * len(payload.updates)
+    operations = []
+    queued = {}
+    for index, update in enumerate(payload.updates):
+        order = current.get(update.order_id)
+        if not order:
+            results[index] = OrderStatusResult(order_id=update.order_id, result="not_found")
+        elif update.order_id in queued:
+            results[index] = OrderStatusResult(
+                order_id=update.order_id, result="conflict", detail="Order appears more than once in the batch"
+            )
+        elif order["status"] == update.status.value:
+            results[index] = OrderStatusResult(order_id=update.order_id, result="unchanged", status=update.status)
+        elif order["status"] not in allowed_previous_statuses(update.status):
+            results[index] = OrderStatusResult(
+                order_id=update.order_id,
+                result="invalid_transition",
+                status=order["status"],
+                detail=f"Invalid status transition from {order['status']} to {update.status.value}"
+            )
+        else:
+            queued[update.order_id] = index
+            operations.append(UpdateOne(
+                {"id": update.order_id, "status": order["status"]},
+                {"$set": status_update_fields(update.status), "$addToSet": {"status_batches": batch_token}}
+            ))
+
+    if operations:
+        async with outbox.unit() as session:
+            await db.orders.bulk_write(operations, ordered=False, session=session)
+            applied = {
+                order["id"]
+                async for order in db.orders.find(
+                    {"id": {"$in": list(queued)}, "status_batches": batch_token}, {"_id": 0, "id": 1}, session=session
+                )
+            }
+            if applied:
+                await db.orders.update_many(
+                    {"id": {"$in": list(applied)}}, {"$pull": {"status_batches": batch_token}}, session=session
+                )
+            cancelled = []
+            events = []
+            for order_id, index in queued.items():
+                update = payload.updates[index]
+                if order_id in applied:
+                    results[index] = OrderStatusResult(order_id=order_id, result="updated", status=update.status)
+                    events.append(status_event(current[order_id], current[order_id]["status"], update.status))
+                    if update.status == OrderStatus.CANCELADO:
+                        cancelled.append(current[order_id])
+                else:
+                    results[index] = OrderStatusResult(
+                        order_id=order_id, result="conflict", detail="Order was modified concurrently"
+                    )
+            await outbox.record_many(events, session=session)
+            await restore_stock(cancelled, session=session)
+        for order_id, index in queued.items():
+            if results[index].result == "updated":
+                publish_status_change(current[order_id], current[order_id]["status"], payload.updates[index].status)
+
+    return results
+
+def rendered_response(key: str, data: bytes, fmt: str):
+    return Response(
+        content=data,
+        media_type=MEDIA_TYPES[fmt],
+        headers={"ETag": f'"{key}"', "Cache-Control": "private, max-age=86400"}
+    )
+
+def not_modified(request: Request, key: str):
+    return request.headers.get("if-none-match") == f'"{key}"'
+
+@api_router.get("/orders/{order_id}/qr")
+async def get_order_qr(order_id: str, request: Request, format: str = "png"):
+    if format not in ("png", "svg"):
+        raise HTTPException(status_code=400, detail="Format must be png or svg")
+    order = await find_order(order_id, {"_id": 0, "id": 1, "total": 1})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    payload = payment_payload(order)
+    key = RenderCache.key("qr", format, payload)
+    if not_modified(request, key):
+        return Response(status_code=304, headers={"ETag": f'"{key}"'})
+    data = await render_cache.get(key, format, render_qr, payload, format)
+    return rendered_response(key, data, format)
+
+@api_router.get("/orders/{order_id}/invoice")
+async def get_order_invoice(order_id: str, request: Request):
+    order = await find_order(order_id, {"_id": 0})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    content = invoice_content(order)
+    key = RenderCache.key("invoice", "html", content)
+    if not_modified(request, key):
+        return Response(status_code=304, headers={"ETag": f'"{key}"'})
+    data = await render_cache.get(key, "html", render_invoice, content)
+    return rendered_response(key, data, "html")
+
 # WhatsApp Simulation
 @api_router.get("/whatsapp/messages", response_model=List[WhatsAppMessage])
-async def get_whatsapp_messages():
-    messages = await db.whatsapp_messages.find().sort("created_at", -1).limit(50).to_list(50)
-    return [WhatsAppMessage(**msg) for msg in messages]
+async def get_whatsapp_messages(
+    phone: Optional[str] = None, since: Optional[datetime] = None, fields: Optional[str] = None
+):
+    projection, selected = field_projection(WhatsAppMessage, fields)
+    query = {"phone": phone} if phone else {}
+    if since:
+        messages = await find_with_archive(
+            db, "whatsapp_messages", query, since, 50, match=query, projection=projection
+        )
+    else:
+        messages = await db.whatsapp_messages.find(query, projection).sort("created_at", -1).limit(50).to_list(50)
+    return resource_response(WhatsAppMessage, messages, selected)
 
 @api_router.post("/whatsapp/send")
 async def send_whatsapp_message(phone: str, message: str):
@@ -352,6 +1207,7 @@ async def send_whatsapp_message(phone: str, message: str):
         processed=True
     )
     await db.whatsapp_messages.insert_one(msg.dict())
+    publish_whatsapp_message(msg)
     return {"status": "sent", "message": "Mensaje enviado via WhatsApp Business"}
 
 @api_router.post("/whatsapp/process")
@@ -371,13 +1227,70 @@ async def process_whatsapp_command(phone: str, message: str):
             product_name = " ".join(parts[1:])
             product = await db.products.find_one({"name": {"$regex": product_name, "$options": "i"}})
             if product:
-                response = f"📦 Stock de {product['name']}: {product['stock']} unidades\n💰 Precio: Bs. {product['sale_price']}"
+                # Available-to-promise: one inventory document per branch, held units excluded
+                entries = await db[INVENTORY_COLLECTION].find(
+                    {"product_id": product["id"]}, {"_id": 0, "stock": 1, "held": 1}
+                ).to_list(100)
+                units = sum(available(entry) for entry in entries) if entries else product["stock"]
+                response = f"📦 Stock de {product['name']}: {units} unidades\n💰 Precio: Bs. {product['sale_price']}"
             else:
                 response = f"❌ Producto '{product_name}' no encontrado"
         
+        elif command == "/pedido" and len(parts) > 2 and parts[-1].isdigit():
+            product_name = " ".join(parts[1:-1])
+            quantity = int(parts[-1])
+            product = await db.products.find_one({"name": {"$regex": re.escape(product_name), "$options": "i"}})
+            if not product:
+                response = f"❌ Producto '{product_name}' no encontrado"
+            else:
+                cart_id = whatsapp_cart_id(phone)
+                try:
+                    hold = await place_hold(db, cart_id, DEFAULT_BRANCH_ID, product["id"], quantity)
+                except (InsufficientStock, HoldConflict):
+                    hold = False
+                if hold is False:
+                    response = f"❌ No hay {quantity} unidades disponibles de {product['name']}"
+                elif hold is None:
+                    response = f"🗑️ {product['name']} quitado del carrito"
+                else:
+                    response = (
+                        f"🛒 Reservado: {quantity} x {product['name']} por {HOLD_TTL_SECONDS // 60} minutos\n"
+                        "Escriba /confirmar para completar su pedido"
+                    )
+        
         elif command == "/pedido":
             response = "🛒 Para hacer un pedido, use: /pedido [producto] [cantidad]\nEjemplo: /pedido Cerveza Pilsener 6"
         
+        elif command == "/confirmar":
+            customer = await find_customer_by_phone(phone)
+            if not customer:
+                response = "❌ No encontramos un cliente registrado con este número."
+            else:
+                try:
+                    order = await create_order(OrderCreate(customer_id=customer["id"], cart_id=whatsapp_cart_id(phone)))
+                    response = f"✅ Pedido confirmado\n🧾 Total: Bs. {order.total:.2f}\n📦 Estado: {order.status.value}"
+                except HTTPException as exc:
+                    response = f"❌ {exc.detail}"
+        
+        elif command == "/mis_pedidos":
+            customer = await find_customer_by_phone(phone)
+            if not customer:
+                response = "❌ No encontramos un cliente registrado con este número."
+            else:
+                orders = await db.orders.find(
+                    {"customer_id": customer["id"]}
+                ).sort([("created_at", -1), ("id", -1)]).limit(5).to_list(5)
+                if orders:
+                    lines = [
+                        f"• {order['created_at'].strftime('%d/%m')} - Bs. {order['total']:.2f} - {order['status']}"
+                        for order in orders
+                    ]
+                    response = f"🛍️ Tus últimos pedidos, {customer['name']}:\n" + "\n".join(lines)
+                    if customer.get("preferred_products"):
+                        response += "\n⭐ Tus favoritos: " + ", ".join(customer["preferred_products"])
+                else:
+                    response = f"🛍️ {customer['name']}, aún no tienes pedidos registrados."
+        
         elif command == "/reporte" and len(parts) > 1:
             report_type = parts[1]
             if report_type == "ventas":
@@ -385,6 +1298,21 @@ async def process_whatsapp_command(phone: str, message: str):
                     "created_at": {"$gte": datetime.now(timezone.utc).replace(hour=0, minute=0, second=0)}
                 })
                 response = f"📊 Reporte de Ventas de Hoy:\n🛍️ Pedidos: {today_orders}\n💰 Ingresos: Calculando..."
+            elif report_type == "inventario":
+                report = await get_inventory_report(branch_id=None)
+                totals = report.totals
+                lines = [
+                    f"• {line.category}: {line.units} u. - Bs. {line.sale_value:.2f}" for line in report.categories
+                ]
+                response = (
+                    f"📊 Reporte de Inventario:\n"
+                    f"📦 Unidades: {totals.units} ({totals.products} productos)\n"
+                    f"💵 Valor al costo: Bs. {totals.cost_value:.2f}\n"
+                    f"💰 Valor de venta: Bs. {totals.sale_value:.2f}\n"
+                    f"📈 Margen potencial: Bs. {totals.potential_margin:.2f}\n"
+                    f"⚠️ Stock bajo: {totals.low_stock}\n"
+                    f"⏳ Por vencer ({report.expiring_days} días): {totals.expiring}\n"
+                ) + "\n".join(lines)
             else:
                 response = "📊 Reportes disponibles:\n- /reporte ventas\n- /reporte inventario"
         
@@ -396,7 +1324,8 @@ async def process_whatsapp_command(phone: str, message: str):
 /productos - Ver catálogo completo
 
 🛒 PEDIDOS:
-/pedido [producto] [cantidad] - Hacer pedido
+/pedido [producto] [cantidad] - Reservar producto
+/confirmar - Confirmar pedido reservado
 /mis_pedidos - Ver mis pedidos
 
 📊 REPORTES:
@@ -418,13 +1347,15 @@ async def process_whatsapp_command(phone: str, message: str):
     msg.processed = True
     
     await db.whatsapp_messages.insert_one(msg.dict())
+    publish_whatsapp_message(msg)
     return {"response": response, "command": command}
 
 # Social Media
 @api_router.get("/social-media/posts", response_model=List[SocialMediaPost])
-async def get_social_media_posts():
-    posts = await db.social_media_posts.find().sort("created_at", -1).to_list(100)
-    return [SocialMediaPost(**post) for post in posts]
+async def get_social_media_posts(fields: Optional[str] = None):
+    projection, selected = field_projection(SocialMediaPost, fields)
+    posts = await db.social_media_posts.find({}, projection).sort("created_at", -1).to_list(100)
+    return resource_response(SocialMediaPost, posts, selected)
 
 @api_router.post("/social-media/create-ad")
 async def create_social_media_ad(platform: str, product_id: Optional[str] = None):
@@ -471,9 +1402,148 @@ async def create_social_media_ad(platform: str, product_id: Optional[str] = None
         "post": post
     }
 
+# Live updates
+@api_router.get("/events/stream")
+async def stream_live_events(request: Request, topics: Optional[str] = None):
+    selected = [t for t in topics.split(",") if t in TOPICS] if topics else None
+    subscription = event_bus.subscribe(selected)
+    if subscription is None:
+        raise HTTPException(status_code=503, detail="Too many live connections")
+    last_event_id = request.headers.get("last-event-id")
+    return StreamingResponse(
+        stream_events(event_bus, subscription, int(last_event_id) if last_event_id and last_event_id.isdigit() else None),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Archive
+@api_router.post("/archive/run")
+async def run_archive(collection: Optional[str] = None, older_than_days: Optional[int] = None):
+    if collection and collection not in RETENTION_DAYS:
+        raise HTTPException(status_code=400, detail=f"Collection {collection} is not archivable")
+    collections = [collection] if collection else list(RETENTION_DAYS)
+
+    async def archive():
+        return {name: await archive_collection(db, name, older_than_days) for name in collections}
+
+    # Under the archive job's lease: two runs appending to the same partition would corrupt it
+    run = await scheduler.run("archive", func=archive)
+    if run is None:
+        raise HTTPException(status_code=409, detail="Archive is already running on another worker")
+    if run["status"] == "error":
+        raise HTTPException(status_code=500, detail=run["error"])
+    return {"status": "success", "archived": run["result"]}
+
+# Scheduled jobs (cron in UTC; Bolivia is UTC-4)
+@scheduler.job("expiring_products", "0 11 * * *")
+async def alert_expiring_products():
+    products = await find_expiring_products(EXPIRY_ALERT_DAYS)
+    for product in products:
+        event_bus.publish("stock", "product.expiring", {
+            "product_id": product["id"],
+            "name": product["name"],
+            "expiry_at": product["expiry_at"],
+            "stock": product["stock"]
+        })
+    return {"expiring": len(products), "product_ids": [product["id"] for product in products[:50]]}
+
+@scheduler.job("expire_holds", "* * * * *", jitter_seconds=5)
+async def scheduled_hold_sweep():
+    return {"released": await sweep_expired_holds(db), "reconciled": await reconcile_held(db)}
+
+@scheduler.job("reorder_forecast", "0 8 * * *")
+async def scheduled_forecast_refresh():
+    return await refresh_reorder_suggestions(db)
+
+@scheduler.job("archive", "0 9 * * *", jitter_seconds=120)
+async def scheduled_archive():
+    return {name: await archive_collection(db, name) for name in RETENTION_DAYS}
+
+@api_router.get("/scheduler/jobs")
+async def get_scheduler_jobs():
+    jobs = scheduler.describe()
+    for job in jobs:
+        job["last_run"] = await db[RUNS_COLLECTION].find_one(
+            {"job": job["name"]}, {"_id": 0}, sort=[("started_at", -1)]
+        )
+    return jobs
+
+@api_router.get("/scheduler/runs")
+async def get_scheduler_runs(job: Optional[str] = None, limit: int = 50):
+    limit = max(1, min(limit, 500))
+    query = {"job": job} if job else {}
+    return await db[RUNS_COLLECTION].find(query, {"_id": 0}).sort("started_at", -1).limit(limit).to_list(limit)
+
+@api_router.post("/scheduler/jobs/{name}/run")
+async def trigger_scheduler_job(name: str):
+    if name not in scheduler.jobs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    run = await scheduler.run(name)
+    if run is None:
+        raise HTTPException(status_code=409, detail="Job is already running on another worker")
+    return run
+
+# Metrics
+@api_router.get("/metrics")
+async def get_metrics():
+    return {
+        "live_events": event_bus.stats(),
+        "outbox": await outbox_dispatcher.stats(),
+        "admission": admission.stats(),
+        "render_cache": render_cache.stats(),
+        "read_caches": cache_stats(),
+        "whatsapp_rate_limited": whatsapp_limiter.limited
+    }
+
+@api_router.post("/outbox/consumers/{name}/replay")
+async def replay_outbox_consumer(name: str, from_seq: int = 0):
+    if name not in outbox_dispatcher.consumers:
+        raise HTTPException(status_code=404, detail="Consumer not found")
+    await outbox_dispatcher.replay(name, from_seq)
+    return {"status": "success", "consumer": name, "from_seq": from_seq}
+
 # Include the router in the main app
 app.include_router(api_router)
 
+def request_priority(method: str, path: str):
+    # Checkout and order status changes always go first
+    if method == "POST" and (path == "/api/orders" or path.endswith("/orders/repeat")):
+        return CRITICAL
+    if (path.startswith("/api/orders/") and path.endswith("/status")) or path == "/api/orders/status/bulk":
+        return CRITICAL
+    if path in CHAT_PATHS:
+        return CHAT
+    return NORMAL
+
+@app.middleware("http")
+async def throttle_requests(request: Request, call_next):
+    path = request.url.path
+    if path in UNTHROTTLED_PATHS or not path.startswith("/api"):
+        return await call_next(request)
+
+    if path in CHAT_PATHS:
+        phone = normalize_phone(request.query_params.get("phone", "")) or "unknown"
+        allowed, retry_after = whatsapp_limiter.check(phone)
+        if not allowed:
+            return JSONResponse(
+                status_code=429,
+                content={"detail": "Too many messages from this number"},
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+            )
+
+    try:
+        await admission.acquire(request_priority(request.method, path))
+    except Overloaded as exc:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Server overloaded, retry later"},
+            headers={"Retry-After": str(exc.retry_after)}
+        )
+    try:
+        return await call_next(request)
+    finally:
+        admission.release()
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -489,6 +1559,72 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    await db.orders.create_index("created_at")
+    # Dashboard pending count across branches; (branch_id, status) only serves one branch
+    await db.orders.create_index("status")
+    await db.orders.create_index([("customer_id", 1), ("created_at", -1), ("id", -1)])
+    # Lookups that fall back to the archive (ARCHIVE_MODE=collection)
+    await db.orders_archive.create_index("id")
+    await db.orders_archive.create_index([("customer_id", 1), ("created_at", -1)])
+    await db.customer_product_counts.create_index([("customer_id", 1), ("product_id", 1)], unique=True)
+    await db.customer_product_counts.create_index([("customer_id", 1), ("quantity", -1)])
+    await db[SUGGESTIONS_COLLECTION].create_index("product_id", unique=True)
+    await db[EVENTS_COLLECTION].create_index("seq", unique=True)
+    await db.whatsapp_messages.create_index("created_at")
+    await db.social_media_posts.create_index("created_at")
+    await db.customers.create_index("phone_e164")
+    await db.customers.create_index("name_lower")
+    await db.products.create_index("expiry_at", sparse=True)
+    await db[RUNS_COLLECTION].create_index([("job", 1), ("started_at", -1)])
+    # TTL: expire_holds alone records a run every minute
+    try:
+        await db[RUNS_COLLECTION].create_index("started_at", expireAfterSeconds=RUNS_RETENTION_SECONDS)
+    except OperationFailure:
+        # Created without TTL by an earlier version; index options cannot be changed in place
+        await db[RUNS_COLLECTION].drop_index("started_at_1")
+        await db[RUNS_COLLECTION].create_index("started_at", expireAfterSeconds=RUNS_RETENTION_SECONDS)
+    # Branch-leading keys, ready to become shard keys
+    await db[INVENTORY_COLLECTION].create_index([("branch_id", 1), ("product_id", 1)], unique=True)
+    await db[INVENTORY_COLLECTION].create_index("product_id")
+    await db.orders.create_index([("branch_id", 1), ("created_at", -1)])
+    await db.orders.create_index([("branch_id", 1), ("status", 1)])
+    await db[BRANCHES_COLLECTION].create_index("id", unique=True)
+    await db[HOLDS_COLLECTION].create_index([("cart_id", 1), ("product_id", 1)], unique=True)
+    await db[HOLDS_COLLECTION].create_index("id", unique=True)
+    # Backstop only: the sweeper gives held units back, the TTL monitor just deletes
+    await db[HOLDS_COLLECTION].create_index("expires_at", expireAfterSeconds=TTL_INDEX_GRACE_SECONDS)
+
+    # Backfill search fields for customers inserted without them
+    async for customer in db.customers.find({"phone_e164": {"$exists": False}}, {"_id": 1, "phone": 1, "name": 1}):
+        await db.customers.update_one({"_id": customer["_id"]}, {"$set": customer_search_fields(customer)})
+
+    # Parse free-form expiry dates stored before expiry_at existed
+    async for product in db.products.find(
+        {"expiry_date": {"$nin": [None, ""]}, "expiry_at": {"$exists": False}}, {"_id": 1, "expiry_date": 1}
+    ):
+        await db.products.update_one(
+            {"_id": product["_id"]}, {"$set": {"expiry_at": parse_expiry_date(product["expiry_date"])}}
+        )
+
+    # Stock and orders from before branches belong to the default branch
+    await ensure_default_branch(db)
+    await seed_branch_stock(db)
+    await db.orders.update_many({"branch_id": {"$exists": False}}, {"$set": {"branch_id": DEFAULT_BRANCH_ID}})
+
+@app.on_event("startup")
+async def start_outbox_dispatcher():
+    await outbox.detect_transactions()
+    await outbox_dispatcher.start()
+
+@app.on_event("startup")
+async def start_scheduler():
+    await scheduler.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await scheduler.stop()
+    await outbox_dispatcher.stop()
+    render_cache.shutdown()
     client.close()
\ No newline at end of file
@@ -1,7 +1,8 @@
 import requests
 import sys
 import json
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 class TambarExpressAPITester:
     def __init__(self, base_url="https://liquor-system.preview.emergentagent.com"):
@@ -26,7 +27,9 @@ class TambarExpressAPITester:
             elif method == 'POST':
                 response = requests.post(url, json=data, headers=headers, params=params)
             elif method == 'PUT':
-                response = requests.put(url, json=data, headers=headers)
+                response = requests.put(url, json=data, headers=headers, params=params)
+            elif method == 'DELETE':
+                response = requests.delete(url, headers=headers)
 
             success = response.status_code == expected_status
             if success:
@@ -68,6 +71,17 @@ class TambarExpressAPITester:
             print("✅ All required dashboard fields present")
         return success
 
+    def test_metrics(self):
+        """Test metrics endpoint exposes outbox consumer lag"""
+        success, response = self.run_test("Metrics", "GET", "metrics", 200)
+        if success:
+            consumers = response.get("outbox", {}).get("consumers", {})
+            for name, consumer in consumers.items():
+                print(f"   Consumer {name}: lag {consumer.get('lag')}")
+            for name, cache in response.get("read_caches", {}).items():
+                print(f"   Cache {name}: hit ratio {cache.get('hit_ratio')}, coalescing {cache.get('coalescing_ratio')}")
+        return success
+
     def test_get_products(self):
         """Test getting products list"""
         success, response = self.run_test("Get Products", "GET", "products", 200)
@@ -109,10 +123,173 @@ class TambarExpressAPITester:
                 print(f"❌ Margin calculation incorrect. Expected: {expected_margin}, Got: {response.get('margin')}")
         return success
 
+    def test_batch_products(self):
+        """Test batch fetch by ids with sparse fields"""
+        if not self.created_product_id:
+            print("⚠️  Skipping batch fetch test - no product ID available")
+            return True
+        success, response = self.run_test(
+            "Batch Products", "GET", "products", 200,
+            params={"ids": self.created_product_id, "fields": "name,stock"}
+        )
+        if success and response and set(response[0]) != {"id", "name", "stock"}:
+            print(f"❌ Unexpected fields in sparse response: {sorted(response[0])}")
+            return False
+        return success
+
     def test_low_stock_products(self):
         """Test getting low stock products"""
         return self.run_test("Low Stock Products", "GET", "products/low-stock", 200)
 
+    def test_branch_inventory(self):
+        """Test per-branch inventory and branch-filtered dashboard"""
+        success, branches = self.run_test("Get Branches", "GET", "branches", 200)
+        if not success or not branches:
+            return False
+        branch_id = branches[0]["id"]
+        if not self.run_test("Branch Inventory", "GET", "inventory", 200, params={"branch_id": branch_id})[0]:
+            return False
+        if not self.run_test("Branch Low Stock", "GET", "products/low-stock", 200, params={"branch_id": branch_id})[0]:
+            return False
+        success, stats = self.run_test("Branch Dashboard", "GET", "dashboard/stats", 200, params={"branch_id": branch_id})
+        if success and stats.get("branch_id") != branch_id:
+            print(f"❌ Dashboard not filtered by branch: {stats.get('branch_id')}")
+            return False
+        return success
+
+    def test_cart_holds(self):
+        """Test holding stock in a cart and releasing it"""
+        if not self.created_product_id:
+            print("⚠️  Skipping cart holds test - no product ID available")
+            return True
+        cart_id = f"test-{datetime.now().strftime('%H%M%S')}"
+        success, cart = self.run_test(
+            "Hold Stock", "PUT", f"carts/{cart_id}/holds", 200,
+            data={"product_id": self.created_product_id, "quantity": 2}
+        )
+        if not success:
+            return False
+        if [hold["quantity"] for hold in cart["holds"]] != [2]:
+            print(f"❌ Unexpected holds: {cart['holds']}")
+            return False
+        branch_id = cart["holds"][0]["branch_id"]
+        if not self.run_test(
+            "Stock Below Held", "PUT", f"inventory/{branch_id}/{self.created_product_id}", 400,
+            data={"stock": 1}
+        )[0]:
+            return False
+        return self.run_test(
+            "Release Hold", "DELETE", f"carts/{cart_id}/holds/{self.created_product_id}", 200
+        )[0]
+
+    def test_scheduler_overlap(self):
+        """Test a manual job trigger while the job runs is refused with 409"""
+        url = f"{self.api_url}/scheduler/jobs/reorder_forecast/run"
+        self.tests_run += 1
+        print(f"\n🔍 Testing Scheduler Overlap...")
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            responses = list(pool.map(lambda _: requests.post(url), range(3)))
+        statuses = [response.status_code for response in responses]
+        runs = sorted(
+            (datetime.fromisoformat(response.json()["started_at"]), response.json()["duration_ms"])
+            for response in responses if response.status_code == 200
+        )
+        overlapping = any(
+            later < earlier + timedelta(milliseconds=duration)
+            for (earlier, duration), (later, _) in zip(runs, runs[1:])
+        )
+        if not runs or set(statuses) - {200, 409} or overlapping:
+            print(f"❌ Failed - Statuses {statuses}, overlapping runs: {overlapping}")
+            return False
+        self.tests_passed += 1
+        print(f"✅ Passed - Statuses {statuses}")
+        return True
+
+    def branch_stock(self, branch_id, product_id):
+        success, entries = self.run_test("Product Inventory", "GET", "inventory", 200, params={"product_id": product_id})
+        return next((entry["stock"] for entry in entries if entry["branch_id"] == branch_id), None) if success else None
+
+    def test_order_status(self):
+        """Test order status transitions, bulk results and stock restored on cancel"""
+        success, customers = self.run_test("Customers For Orders", "GET", "customers", 200)
+        if not success or not customers or not self.created_product_id:
+            print("⚠️  Skipping order status test - no customer or product available")
+            return success
+        success, order = self.run_test("Create Order", "POST", "orders", 200, data={
+            "customer_id": customers[0]["id"], "items": [{"product_id": self.created_product_id, "quantity": 1}]
+        })
+        if not success:
+            return False
+        branch_id, order_id = order["branch_id"], order["id"]
+        after_order = self.branch_stock(branch_id, self.created_product_id)
+
+        success, results = self.run_test("Bulk Status", "POST", "orders/status/bulk", 200, data={"updates": [
+            {"order_id": order_id, "status": "entregado"},
+            {"order_id": "no-such-order", "status": "confirmado"},
+        ]})
+        if not success or [result["result"] for result in results] != ["invalid_transition", "not_found"]:
+            print(f"❌ Unexpected bulk results: {results}")
+            return False
+        success, results = self.run_test("Bulk Confirm", "POST", "orders/status/bulk", 200, data={"updates": [
+            {"order_id": order_id, "status": "confirmado"},
+        ]})
+        if not success or [result["result"] for result in results] != ["updated"]:
+            print(f"❌ Unexpected bulk results: {results}")
+            return False
+
+        if not self.run_test(
+            "Invalid Transition", "PUT", f"orders/{order_id}/status", 409, params={"status": "entregado"}
+        )[0]:
+            return False
+        if not self.run_test("Cancel Order", "PUT", f"orders/{order_id}/status", 200, params={"status": "cancelado"})[0]:
+            return False
+        restored = self.branch_stock(branch_id, self.created_product_id)
+        if after_order is None or restored != after_order + 1:
+            print(f"❌ Stock not restored on cancel: {after_order} -> {restored}")
+            return False
+        return True
+
+    def test_order_documents(self):
+        """Test payment QR and invoice rendering with ETag revalidation"""
+        success, orders = self.run_test("Orders For Documents", "GET", "orders", 200, params={"fields": "id"})
+        if not success or not orders:
+            print("⚠️  Skipping QR/invoice test - no orders available")
+            return success
+        order_id = orders[0]["id"]
+        checks = [("qr", {"format": "png"}, "image/png"), ("qr", {"format": "svg"}, "image/svg+xml"),
+                  ("invoice", {}, "text/html")]
+        for document, params, media_type in checks:
+            url = f"{self.api_url}/orders/{order_id}/{document}"
+            self.tests_run += 1
+            print(f"\n🔍 Testing Order {document} {params.get('format', '')}...")
+            response = requests.get(url, params=params)
+            etag = response.headers.get("ETag")
+            if response.status_code != 200 or not response.headers.get("Content-Type", "").startswith(media_type) or not etag:
+                print(f"❌ Failed - Status {response.status_code}, type {response.headers.get('Content-Type')}, ETag {etag}")
+                return False
+            revalidated = requests.get(url, params=params, headers={"If-None-Match": etag})
+            if revalidated.status_code != 304:
+                print(f"❌ Failed - Expected 304 for matching ETag, got {revalidated.status_code}")
+                return False
+            self.tests_passed += 1
+            print(f"✅ Passed - {len(response.content)} bytes, 304 on revalidation")
+        return True
+
+    def test_inventory_report(self):
+        """Test inventory valuation report"""
+        success, response = self.run_test("Inventory Report", "GET", "reports/inventory", 200)
+        if success and response["totals"]["units"] != sum(line["units"] for line in response["categories"]):
+            print("❌ Report totals do not add up to the categories")
+            return False
+        return success
+
+    def test_reorder_suggestions(self):
+        """Test forecast refresh and reorder suggestions"""
+        success, _ = self.run_test("Refresh Forecast", "POST", "inventory/forecast/refresh", 200)
+        if not success:
+            return False
+        return self.run_test("Reorder Suggestions", "GET", "inventory/reorder-suggestions", 200)[0]
+
     def test_get_customers(self):
         """Test getting customers list"""
         return self.run_test("Get Customers", "GET", "customers", 200)
@@ -128,6 +305,25 @@ class TambarExpressAPITester:
         
         return self.run_test("Create Customer", "POST", "customers", 200, data=test_customer)
 
+    def test_search_customers(self):
+        """Test customer lookup by phone and name prefix"""
+        success, response = self.run_test(
+            "Search Customer by Phone", "GET", "customers/search", 200, params={"q": "70000001"}
+        )
+        if success and isinstance(response, list) and response:
+            print(f"✅ Phone lookup resolved to: {response[0].get('name')}")
+        return self.run_test("Search Customer by Name", "GET", "customers/search", 200, params={"q": "Clien"})[0]
+
+    def test_customer_orders(self):
+        """Test paginated order history for a customer"""
+        success, customers = self.run_test("Get Customers for History", "GET", "customers", 200)
+        if not success or not customers:
+            print("⚠️  Skipping customer history test - no customers available")
+            return True
+        return self.run_test(
+            "Customer Order History", "GET", f"customers/{customers[0]['id']}/orders", 200, params={"limit": 5}
+        )[0]
+
     def test_get_orders(self):
         """Test getting orders list"""
         return self.run_test("Get Orders", "GET", "orders", 200)
@@ -214,18 +410,29 @@ class TambarExpressAPITester:
         
         # Dashboard tests
         self.test_dashboard_stats()
+        self.test_metrics()
+        self.test_scheduler_overlap()
         
         # Product management tests
         self.test_get_products()
         self.test_create_product()
+        self.test_batch_products()
         self.test_low_stock_products()
+        self.test_branch_inventory()
+        self.test_cart_holds()
+        self.test_inventory_report()
+        self.test_reorder_suggestions()
         
         # Customer management tests
         self.test_get_customers()
         self.test_create_customer()
+        self.test_search_customers()
         
         # Order management tests
         self.test_get_orders()
+        self.test_customer_orders()
+        self.test_order_status()
+        self.test_order_documents()
         
         # WhatsApp Business tests
         self.test_whatsapp_messages()
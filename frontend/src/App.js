@@ -91,7 +91,38 @@ const Dashboard = () => {
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
+    let source;
+    let closed = false;
+
+    // Apply counter deltas pushed by the backend instead of polling
+    const connect = () => {
+      source = new EventSource(`${API}/events/stream?topics=dashboard`);
+      source.addEventListener("dashboard", (event) => {
+        const { data } = JSON.parse(event.data);
+        setStats((current) => {
+          if (!current) return current;
+          const next = { ...current };
+          Object.entries(data).forEach(([key, delta]) => {
+            if (key in next) next[key] += delta;
+          });
+          return next;
+        });
+      });
+      // The refetched stats already include the missed deltas, so start a new
+      // stream instead of letting this one replay them from Last-Event-ID
+      source.addEventListener("evicted", async () => {
+        source.close();
+        await fetchStats();
+        if (!closed) connect();
+      });
+    };
+
     fetchStats();
+    connect();
+    return () => {
+      closed = true;
+      source.close();
+    };
   }, []);
 
   const fetchStats = async () => {